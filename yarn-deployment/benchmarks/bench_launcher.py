@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline benchmark of the gateway side overhead of yarn_dbt. The hadoop, yarn, hdfs and
+# kinit executables are replaced by stand-ins with configurable latencies and the
+# ResourceManager REST apis by an in-process stub, so the launcher runs end to end
+# without a cluster. The time yarn_dbt waits for the stand-in processes, from starting
+# them until they are reaped, is subtracted from the wall time of every scenario, what
+# remains is the overhead of yarn_dbt itself.
+#
+# usage: python3 benchmarks/bench_launcher.py [--sizes 10,200,2000] [--repeat 3]
+#            [--apps 20000] [--latency hadoop=0.5,yarn=0.2] [--output results.json]
+#            [--baseline results.json --tolerance 0.25]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Stand-in for the hadoop, yarn, hdfs and kinit executables, dispatched on the name it is
+# invoked as. Every call is appended to BENCH_CALL_LOG with the injected latency.
+FAKE_TOOL = r"""#!{python}
+import hashlib, json, os, sys, time, urllib.request
+from datetime import datetime
+
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+latency = float(os.environ.get("BENCH_LATENCY_" + tool.upper(), "0"))
+time.sleep(latency)
+with open(os.environ["BENCH_CALL_LOG"], "a") as f:
+    f.write(json.dumps({{"tool": tool, "args": args[:3], "latency": latency}}) + "\n")
+
+if tool == "hadoop":
+    # distributed shell client: register the application with the stub ResourceManager
+    name = args[args.index("-appname") + 1]
+    tags = args[args.index("-application_tags") + 1]
+    request = urllib.request.Request(
+        os.environ["BENCH_RM_URI"] + "/bench/apps",
+        data=json.dumps({{"name": name, "applicationTags": tags}}).encode(),
+        method="POST",
+    )
+    yarn_id = json.load(urllib.request.urlopen(request))["id"]
+    if os.environ.get("BENCH_HIDE_APP_ID") != "1":
+        print("INFO impl.YarnClientImpl: Submitted application " + yarn_id, file=sys.stderr)
+elif tool == "yarn" and args[:1] == ["logs"]:
+    now = datetime.now().astimezone()
+    markers = []
+    for phase in ["Kinit", "Setup python environment", "Run dbt command"]:
+        for edge in ["start", "end"]:
+            markers.append(
+                "dbt.bench: {{}} {{}}: {{}}".format(
+                    phase, edge, now.strftime("%Y-%m-%d:%H:%M:%S.%f")[:-3] + now.strftime("%z")
+                )
+            )
+    log = "\n".join(markers + ["Completed successfully"] * 50)
+    print("Container: container_1_1_01_000002 on node_8041")
+    print("LogAggregationType: AGGREGATED")
+    print("====")
+    print("LogType:prelaunch.out")
+    print("LogLength:{{}}".format(len(log)))
+    print("LogContents:")
+    print(log)
+    print("End of LogType:prelaunch.out")
+elif tool == "hdfs" and "-checksum" in args:
+    for path in args[args.index("-checksum") + 1 :]:
+        print("{{}}\tMD5-of-0MD5-of-512CRC32C\t{{}}".format(path, hashlib.md5(path.encode()).hexdigest()))
+"""
+
+# Scenarios run for every synthetic project size.
+SCENARIOS = ["run (cold)", "run (warm)", "app id lookup", "docs"]
+
+
+# Process class that records when every child process was started and reaped, also
+# for the processes started by subprocess.run.
+class TimedPopen(subprocess.Popen):
+    intervals = []
+
+    def __init__(self, *args, **kwargs):
+        self.bench_start = time.perf_counter()
+        self.bench_reaped = False
+        super().__init__(*args, **kwargs)
+
+    def record_reaped(self):
+        if self.returncode is not None and not self.bench_reaped:
+            self.bench_reaped = True
+            TimedPopen.intervals.append((self.bench_start, time.perf_counter()))
+
+    def poll(self):
+        returncode = super().poll()
+        self.record_reaped()
+        return returncode
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        self.record_reaped()
+        return returncode
+
+
+# Total time covered by the given intervals within start and end, overlapping child
+# processes are counted once.
+def covered_seconds(intervals, start, end):
+    covered = 0.0
+    position = start
+    for interval_start, interval_end in sorted(intervals):
+        interval_start = max(interval_start, position)
+        interval_end = min(interval_end, end)
+        if interval_end > interval_start:
+            covered += interval_end - interval_start
+            position = interval_end
+    return covered
+
+
+# Stub of the ResourceManager REST apis used by yarn_dbt. Applications registered by the
+# fake distributed shell client are added to a large list of synthetic applications.
+# Services are kept as submitted and are stable right away.
+class StubResourceManager(BaseHTTPRequestHandler):
+    apps = []
+    services = {}
+    lock = threading.Lock()
+    request_count = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, document, status=200):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+    def do_GET(self):
+        StubResourceManager.request_count += 1
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/ws/v1/cluster/apps":
+            apps = [
+                app
+                for app in self.apps
+                if app["user"] == query.get("user", app["user"])
+                and app["applicationTags"]
+                == query.get("applicationTags", app["applicationTags"])
+                and app["startedTime"] >= int(query.get("startedTimeBegin", 0))
+            ]
+            self.send_json({"apps": {"app": apps} if apps else None})
+            return
+
+        match = re.fullmatch(r"/ws/v1/cluster/apps/([^/]+)", url.path)
+        if match:
+            for app in self.apps:
+                if app["id"] == match.group(1):
+                    self.send_json({"app": app})
+                    return
+
+        match = re.fullmatch(r"/app/v1/services/([^/]+)", url.path)
+        if match and match.group(1) in self.services:
+            self.send_json(self.services[match.group(1)])
+            return
+        self.send_json({"message": "not found"}, status=404)
+
+    def do_PUT(self):
+        StubResourceManager.request_count += 1
+        document = self.read_json()
+        if re.fullmatch(r"/ws/v1/cluster/apps/[^/]+/timeout", self.path):
+            self.send_json(document)
+            return
+
+        # service upgrade and flex
+        match = re.fullmatch(
+            r"/app/v1/services/([^/]+)(?:/components/([^/]+))?", self.path
+        )
+        if match and match.group(1) in self.services:
+            service = self.services[match.group(1)]
+            if match.group(2) is None:
+                service["version"] = document["version"]
+            else:
+                for component in service["components"]:
+                    if component["name"] == match.group(2):
+                        component.update(document)
+            self.send_json({"diagnostics": "Service {} updated".format(match.group(1))})
+            return
+        self.send_json({"message": "not found"}, status=404)
+
+    def do_DELETE(self):
+        StubResourceManager.request_count += 1
+        self.services.pop(self.path.rsplit("/", 1)[-1], None)
+        self.send_json({"diagnostics": "Service destroyed"})
+
+    def do_POST(self):
+        StubResourceManager.request_count += 1
+        document = self.read_json()
+        if self.path == "/bench/apps":
+            now = int(time.time() * 1000)
+            with self.lock:
+                app = synthetic_app(len(self.apps) + 1, now)
+                app.update(
+                    name=document["name"],
+                    user=os.environ["BENCH_USER"],
+                    applicationTags=document["applicationTags"].lower(),
+                    launchTime=now + 5,
+                    finishedTime=now + 10,
+                )
+                self.apps.append(app)
+            self.send_json({"id": app["id"]})
+        elif self.path == "/app/v1/services":
+            document["state"] = "STABLE"
+            self.services[document["name"]] = document
+            self.send_json({"diagnostics": "Application ID: application_1_1"}, 202)
+        else:
+            self.send_json({"message": "not found"}, status=404)
+
+
+def synthetic_app(index, started_time):
+    return {
+        "id": "application_1700000000000_{:06d}".format(index),
+        "name": "dbt.user{}.2023-01-01-00-00-00".format(index % 50),
+        "user": "user{}".format(index % 50),
+        "applicationTags": "yarn-dbt",
+        "state": "FINISHED",
+        "finalStatus": "SUCCEEDED",
+        "progress": 100.0,
+        "elapsedTime": 5,
+        "startedTime": started_time,
+        "launchTime": started_time,
+        "finishedTime": started_time,
+    }
+
+
+# Generate a synthetic dbt project with the given number of models, including some files
+# that are ignored when packaging.
+def generate_project(project_dir, models):
+    rng = random.Random(models)
+    os.makedirs(os.path.join(project_dir, "models"))
+    os.makedirs(os.path.join(project_dir, "target"))
+    with open(os.path.join(project_dir, "dbt_project.yml"), "w") as f:
+        f.write("name: bench\nversion: '1.0'\nprofile: bench\n")
+    with open(os.path.join(project_dir, "profiles.yml"), "w") as f:
+        f.write("bench:\n  target: dev\n  outputs:\n    dev:\n      type: impala\n")
+    for index in range(models):
+        columns = ",\n    ".join(
+            "col_{} as c{}".format(rng.randrange(1000), column)
+            for column in range(rng.randrange(5, 60))
+        )
+        with open(
+            os.path.join(project_dir, "models", "m{}.sql".format(index)), "w"
+        ) as f:
+            f.write(
+                "select\n    {}\nfrom {{{{ ref('m{}') }}}}\n".format(
+                    columns, rng.randrange(max(index, 1))
+                )
+            )
+    with open(os.path.join(project_dir, "target", "manifest.json"), "w") as f:
+        f.write("x" * 1024 * models)
+
+
+def write_yarn_env(home, rm_uri, user):
+    with open(os.path.join(home, "yarn.env"), "w") as f:
+        for key, value in [
+            ("DEPENDENCIES_PACKAGE_PATH_HDFS", "/user/{}/deps".format(user)),
+            ("DEPENDENCIES_PACKAGE_NAME", "dbt-deps.tar.gz"),
+            ("YARN_JAR", "/opt/hadoop-yarn-applications-distributedshell.jar"),
+            ("DBT_SERVICE_USER", "dbt"),
+            ("DBT_PROJECT_NAME", "bench_project"),
+            ("YARN_RM_URI", rm_uri),
+            ("DBT_HEADLESS_KEYTAB", os.path.join(home, "headless.keytab")),
+            ("DBT_HEADLESS_PRINCIPAL", "{}@EXAMPLE.COM".format(user)),
+            ("CURRENT_DBT_USER", user),
+            ("KERBEROS_CCACHE_DIR", home),
+            ("YARN_FOLLOW_INTERVAL", "0"),
+        ]:
+            f.write("{}={}\n".format(key, value))
+
+
+# Run one scenario and return its wall time, the time spent in the stand-ins and
+# the gateway phases from the timing report of yarn_dbt.
+def run_scenario(yarn_dbt, scenario, workspace, call_log):
+    # every invocation of yarn_dbt is a new process, start without memoized state
+    yarn_dbt.YARN_SESSION = None
+    yarn_dbt.DEPENDENCIES_ARTIFACT = None
+    yarn_dbt.SERVICE_USER_KEYTAB = os.path.join(workspace, "dbt.keytab")
+    open(call_log, "w").close()
+    TimedPopen.intervals = []
+    StubResourceManager.request_count = 0
+    os.environ["BENCH_HIDE_APP_ID"] = "0"
+    report_dir = os.path.join(workspace, ".yarn_dbt", "reports")
+    shutil.rmtree(report_dir, ignore_errors=True)
+
+    if scenario == "run (cold)":
+        for name in os.listdir(workspace):
+            if name.startswith("dbt-workspace."):
+                os.remove(os.path.join(workspace, name))
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if scenario == "app id lookup":
+            # the client output doesn't carry the id, it is looked up on the RM
+            sys.argv = ["yarn_dbt", "submit", "run"]
+            os.environ["BENCH_HIDE_APP_ID"] = "1"
+            yarn_dbt.load_fetch_environment_variables()
+            yarn_dbt.subprocess.run(
+                ["hadoop", "-appname", "dbt.lookup", "-application_tags", "yarn-dbt"],
+                check=True,
+                capture_output=True,
+            )
+            start = time.perf_counter()
+            yarn_dbt.get_yarn_app_id("dbt.lookup", "", 0)
+        elif scenario == "docs":
+            sys.argv = ["yarn_dbt", "docs"]
+            yarn_dbt.main()
+        else:
+            sys.argv = ["yarn_dbt", "run"]
+            yarn_dbt.main()
+    end = time.perf_counter()
+    wall = end - start
+
+    with open(call_log) as f:
+        calls = [json.loads(line) for line in f]
+    if scenario == "app id lookup":
+        calls = []
+
+    phases = {}
+    if os.path.isdir(report_dir):
+        for name in os.listdir(report_dir):
+            with open(os.path.join(report_dir, name)) as f:
+                for phase in json.load(f)["phases"]:
+                    if phase["source"] == "gateway":
+                        phases[phase["phase"]] = phase["duration_seconds"]
+
+    return {
+        "wall_seconds": wall,
+        "overhead_seconds": wall - covered_seconds(TimedPopen.intervals, start, end),
+        "subprocess_calls": len(calls),
+        "rm_requests": StubResourceManager.request_count,
+        "phases": phases,
+    }
+
+
+def summarize(samples):
+    summary = {
+        "wall_seconds": statistics.median(s["wall_seconds"] for s in samples),
+        "overhead_seconds": statistics.median(s["overhead_seconds"] for s in samples),
+        "subprocess_calls": samples[-1]["subprocess_calls"],
+        "rm_requests": samples[-1]["rm_requests"],
+        "phases": {},
+    }
+    for phase in samples[-1]["phases"]:
+        summary["phases"][phase] = statistics.median(
+            s["phases"].get(phase, 0) for s in samples
+        )
+    return summary
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for size, scenarios in results.items():
+        for scenario, summary in scenarios.items():
+            previous = baseline.get(size, {}).get(scenario)
+            if previous is None:
+                continue
+            # ignore noise on scenarios that take only a few milliseconds
+            allowed = max(previous["overhead_seconds"] * (1 + tolerance), 0.05)
+            if summary["overhead_seconds"] > allowed:
+                regressions.append(
+                    "{} models, {}: {:.3f}s overhead, baseline {:.3f}s".format(
+                        size,
+                        scenario,
+                        summary["overhead_seconds"],
+                        previous["overhead_seconds"],
+                    )
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the gateway side overhead of yarn_dbt."
+    )
+    parser.add_argument("--sizes", default="10,200,2000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--apps", type=int, default=20000)
+    parser.add_argument("--latency", default="hadoop=0.5,yarn=0.2,hdfs=0.2,kinit=0.1")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    options = parser.parse_args()
+
+    workspace = tempfile.mkdtemp(prefix="yarn-dbt-bench-")
+    bin_dir = os.path.join(workspace, "bin")
+    os.makedirs(bin_dir)
+    for tool in ["hadoop", "yarn", "hdfs", "kinit"]:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(FAKE_TOOL.format(python=sys.executable))
+        os.chmod(path, 0o755)
+    for latency in options.latency.split(","):
+        tool, seconds = latency.split("=")
+        os.environ["BENCH_LATENCY_" + tool.strip().upper()] = seconds
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubResourceManager)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    rm_uri = "http://127.0.0.1:{}".format(server.server_address[1])
+    StubResourceManager.apps = [
+        synthetic_app(index, int(time.time() * 1000) - index * 1000)
+        for index in range(options.apps)
+    ]
+
+    user = "bench"
+    call_log = os.path.join(workspace, "calls.jsonl")
+    os.environ.update(
+        HOME=workspace,
+        PATH=bin_dir + os.pathsep + os.environ["PATH"],
+        BENCH_CALL_LOG=call_log,
+        BENCH_RM_URI=rm_uri,
+        BENCH_USER=user,
+    )
+    write_yarn_env(workspace, rm_uri, user)
+    subprocess.Popen = TimedPopen
+
+    # yarn_dbt resolves its state directory from HOME on import
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import yarn_dbt
+
+    # the stub ResourceManager doesn't negotiate SPNEGO
+    yarn_dbt.HTTPSPNEGOAuth = lambda **kwargs: None
+
+    results = {}
+    os.chdir(workspace)
+    try:
+        for size in options.sizes.split(","):
+            shutil.rmtree(os.path.join(workspace, "bench_project"), ignore_errors=True)
+            generate_project(os.path.join(workspace, "bench_project"), int(size))
+            results[size] = {}
+            for scenario in SCENARIOS:
+                samples = [
+                    run_scenario(yarn_dbt, scenario, workspace, call_log)
+                    for _ in range(options.repeat)
+                ]
+                results[size][scenario] = summarize(samples)
+    finally:
+        server.shutdown()
+        os.chdir("/")
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    print(
+        "{:>8}  {:<14} {:>9} {:>10} {:>6} {:>6}  {}".format(
+            "models",
+            "scenario",
+            "wall (s)",
+            "overhead",
+            "calls",
+            "rm",
+            "gateway phases (s)",
+        )
+    )
+    for size, scenarios in results.items():
+        for scenario, summary in scenarios.items():
+            print(
+                "{:>8}  {:<14} {:>9.3f} {:>10.3f} {:>6} {:>6}  {}".format(
+                    size,
+                    scenario,
+                    summary["wall_seconds"],
+                    summary["overhead_seconds"],
+                    summary["subprocess_calls"],
+                    summary["rm_requests"],
+                    ", ".join(
+                        "{}={:.3f}".format(phase, seconds)
+                        for phase, seconds in summary["phases"].items()
+                    ),
+                )
+            )
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if options.baseline:
+        regressions = compare_with_baseline(
+            results, options.baseline, options.tolerance
+        )
+        for regression in regressions:
+            print("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
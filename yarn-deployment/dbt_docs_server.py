@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Static file server for prebuilt dbt docs, started by the dbt-service yarn container.
+# Requests are served from a thread per connection. Files are compressed once at
+# startup and sent precompressed to clients that accept it, with ETags for revalidation
+# and byte range support for uncompressed responses.
+#
+# usage: dbt_docs_server.py --port <port> --directory <docs directory>
+
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import re
+
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logging.basicConfig(level="INFO", format="%(asctime)s - %(levelname)s: %(message)s")
+
+# files smaller than this aren't worth compressing
+MINIMUM_COMPRESS_SIZE = 1024
+
+# suffix of the precompressed variants of a file, in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+# Write the precompressed variants next to every file of the docs directory.
+def precompress_directory(directory):
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.endswith(tuple(suffix for encoding, suffix in ENCODINGS)):
+                continue
+            path = os.path.join(root, name)
+            if os.path.getsize(path) < MINIMUM_COMPRESS_SIZE:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path + ".gz", "wb") as f:
+                f.write(gzip.compress(data, compresslevel=9))
+            if brotli is not None:
+                with open(path + ".br", "wb") as f:
+                    f.write(brotli.compress(data))
+            logging.info("Precompressed %s", path)
+
+
+class DocsRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.html")
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        # pick the best precompressed variant the client accepts
+        accepted = [
+            encoding.split(";")[0].strip()
+            for encoding in self.headers.get("Accept-Encoding", "").split(",")
+        ]
+        content_encoding = None
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(path + suffix):
+                content_encoding = encoding
+                content_path = path + suffix
+                break
+        if content_encoding is None:
+            content_path = path
+
+        stat = os.stat(content_path)
+        etag = '"{}"'.format(
+            hashlib.sha1(
+                "{}:{}:{}".format(content_path, stat.st_mtime_ns, stat.st_size).encode()
+            ).hexdigest()
+        )
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        # ranges of compressed responses are left out, viewers fetch docs files whole
+        start, end = 0, stat.st_size - 1
+        status = HTTPStatus.OK
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and content_encoding is None and any(match.groups()):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), stat.st_size - 1)
+            else:
+                start = max(stat.st_size - int(match.group(2)), 0)
+            if start > end:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", "bytes */{}".format(stat.st_size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            status = HTTPStatus.PARTIAL_CONTENT
+
+        f = open(content_path, "rb")
+        f.seek(start)
+        self.send_response(status)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Accept-Ranges", "bytes")
+        if content_encoding:
+            self.send_header("Content-Encoding", content_encoding)
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, stat.st_size)
+            )
+        self.end_headers()
+        self.remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        while self.remaining > 0:
+            chunk = source.read(min(self.remaining, 1024 * 1024))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            self.remaining -= len(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve prebuilt dbt docs.")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--directory", default=".")
+    options = parser.parse_args()
+
+    directory = os.path.abspath(options.directory)
+    precompress_directory(directory)
+
+    class Handler(DocsRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+    server = ThreadingHTTPServer(("", options.port), Handler)
+    server.daemon_threads = True
+    logging.info("Serving dbt docs from %s on port %s", directory, options.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
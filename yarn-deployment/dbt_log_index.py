@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compress and index the dbt log of a yarn_dbt container. The json log lines dbt writes
+# with DBT_LOG_FORMAT_FILE=json are grouped by node and level, and every group is
+# written as a separate gzip member of the compressed log. The index records the byte
+# range of every member and the status and timing of every node, so that `yarn_dbt
+# logs` only reads the members it needs. Logs in text format end up in one member.
+#
+# usage: dbt_log_index.py --log <dbt.log> --output <dbt.log.gz> --index <index.json>
+#            [--print-level <level>]
+
+import argparse
+import gzip
+import json
+import os
+import sys
+
+# dbt log levels in order of severity
+LEVELS = ["debug", "info", "warn", "error"]
+
+
+# Return the node, the level and the parsed event of a dbt log line.
+def parse_line(line):
+    try:
+        event = json.loads(line)
+        info = event["info"]
+    except (ValueError, KeyError, TypeError):
+        return "", "info", None
+    node_info = (event.get("data") or {}).get("node_info") or {}
+    level = info.get("level") if info.get("level") in LEVELS else "info"
+    return node_info.get("unique_id", ""), level, event
+
+
+def format_event(event):
+    return "{} [{}] {}\n".format(
+        event["info"].get("ts", ""),
+        event["info"].get("level"),
+        event["info"].get("msg"),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress and index a dbt log.")
+    parser.add_argument("--log", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--index", required=True)
+    parser.add_argument("--print-level", choices=LEVELS)
+    options = parser.parse_args()
+
+    groups = {}
+    nodes = {}
+    with open(options.log, "rb") as f:
+        for line in f:
+            node, level, event = parse_line(line)
+            groups.setdefault((node, level), []).append(line)
+            if event is None:
+                continue
+            if node:
+                node_info = event["data"]["node_info"]
+                # later events of a node carry its final status and timing
+                nodes.setdefault(node, {}).update(
+                    {
+                        key: node_info[field]
+                        for key, field in [
+                            ("status", "node_status"),
+                            ("started_at", "node_started_at"),
+                            ("finished_at", "node_finished_at"),
+                        ]
+                        if node_info.get(field)
+                    }
+                )
+            if options.print_level and LEVELS.index(level) >= LEVELS.index(
+                options.print_level
+            ):
+                sys.stderr.write(format_event(event))
+
+    members = []
+    offset = 0
+    with open(options.output, "wb") as f:
+        for (node, level), lines in groups.items():
+            data = gzip.compress(b"".join(lines))
+            f.write(data)
+            members.append(
+                {
+                    "node": node,
+                    "level": level,
+                    "offset": offset,
+                    "length": len(data),
+                    "lines": len(lines),
+                }
+            )
+            offset += len(data)
+
+    with open(options.index, "w") as f:
+        json.dump(
+            {
+                "log": os.path.basename(options.output),
+                "members": members,
+                "nodes": nodes,
+            },
+            f,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+# Copyright 2022 Cloudera Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Warm dbt worker, started by the dbt-worker yarn service inside the dbt virtualenv. It
+# accepts dbt commands from yarn_dbt over HTTP, authenticated with a bearer token that
+# only the owner of the service can read, and streams the dbt output back. The dbt
+# project stays extracted between commands and is only refreshed when yarn_dbt sends a
+# different project archive. With dbt 1.5 and later the parsed manifest is kept in
+# memory for every profile, target and vars a command uses, older versions reuse the
+# partial parse state in the target directory.
+#
+# usage: dbt_worker.py --port <port> --token-file <file> --workdir <directory>
+#            --staging-dir <hdfs directory> --keytab <keytab> --principal <principal>
+#            [--max-runs <runs>]
+
+import argparse
+import hmac
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from dbt.cli.main import dbtRunner
+except ImportError:
+    dbtRunner = None
+
+logging.basicConfig(level="INFO", format="%(asctime)s - %(levelname)s: %(message)s")
+
+# decompression command of the staged project archives by extension
+DECOMPRESS_COMMANDS = {
+    ".tar.gz": ["gzip", "-dc"],
+    ".tar.zst": ["zstd", "-dcq"],
+    ".tar.lz4": ["lz4", "-dcq"],
+}
+
+# dbt options that change the parsed manifest, it is parsed once for every combination
+PARSE_OPTIONS = ["--profile", "--target", "-t", "--vars"]
+
+# last line of every response, carries the exit code of the dbt command
+EXIT_CODE_MARKER = "yarn_dbt_worker_exit_code: "
+
+
+# Return the options of a dbt command that the manifest is parsed with.
+def get_parse_args(args):
+    parse_args = []
+    for index, arg in enumerate(args):
+        if arg.split("=", 1)[0] in PARSE_OPTIONS and "=" in arg:
+            parse_args.append(arg)
+        elif arg in PARSE_OPTIONS and index + 1 < len(args):
+            parse_args.extend([arg, args[index + 1]])
+    return parse_args
+
+
+# Stream an archive from hdfs through the decompression command into tar, without a
+# shell. Raises CalledProcessError when any of the commands fails.
+def extract_archive(hdfs_path, decompress_command, directory):
+    commands = [
+        ["hdfs", "dfs", "-cat", hdfs_path],
+        decompress_command,
+        ["tar", "-xf", "-", "--directory", directory],
+    ]
+    processes = []
+    with tempfile.TemporaryFile() as errors:
+        for index, command in enumerate(commands):
+            processes.append(
+                subprocess.Popen(
+                    command,
+                    stdin=processes[-1].stdout if processes else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE if index < len(commands) - 1 else None,
+                    stderr=errors,
+                )
+            )
+            # only the next command reads the output
+            if len(processes) > 1:
+                processes[-2].stdout.close()
+        for command, process in zip(commands, processes):
+            if process.wait() != 0:
+                errors.seek(0)
+                raise subprocess.CalledProcessError(
+                    process.returncode, command, stderr=errors.read().decode()
+                )
+
+
+class DbtWorker:
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.project = None
+        self.project_name = None
+        self.manifests = {}
+        self.runs = 0
+        self.last_activity = time.time()
+
+    def project_dir(self):
+        return os.path.join(self.options.workdir, "project", self.project_name)
+
+    # Renew the kerberos ticket of the worker when it expired.
+    def renew_ticket(self):
+        if subprocess.run(["klist", "-s"]).returncode != 0:
+            subprocess.run(
+                ["kinit", "-kt", self.options.keytab, self.options.principal],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+
+    # Tell whether a project archive was staged by yarn_dbt and the project name is a
+    # plain directory name, anything else is rejected before it gets near a command.
+    def is_valid_project(self, project, project_name):
+        return (
+            isinstance(project, str)
+            and isinstance(project_name, str)
+            and os.path.dirname(project) == self.options.staging_dir
+            and any(project.endswith(suffix) for suffix in DECOMPRESS_COMMANDS)
+            and project_name == os.path.basename(project_name)
+            and project_name not in ["", ".", ".."]
+        )
+
+    # Extract a staged project archive unless it is the current project. The partial
+    # parse state of the previous version of the same dbt project is carried over.
+    def sync_project(self, project, project_name):
+        if project == self.project and project_name == self.project_name:
+            return
+        suffix = next(s for s in DECOMPRESS_COMMANDS if project.endswith(s))
+        staging_dir = os.path.join(self.options.workdir, "project.new")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        extract_archive(project, DECOMPRESS_COMMANDS[suffix], staging_dir)
+
+        if project_name == self.project_name:
+            partial_parse = os.path.join(
+                self.project_dir(), "target", "partial_parse.msgpack"
+            )
+            if os.path.isfile(partial_parse):
+                target_dir = os.path.join(staging_dir, project_name, "target")
+                os.makedirs(target_dir, exist_ok=True)
+                shutil.copy2(partial_parse, target_dir)
+
+        shutil.rmtree(os.path.join(self.options.workdir, "project"), ignore_errors=True)
+        os.rename(staging_dir, os.path.join(self.options.workdir, "project"))
+        self.project = project
+        self.project_name = project_name
+        self.manifests = {}
+        logging.info("Extracted dbt project %s", project)
+
+    # Run a dbt command and write its output to the stream. Returns the exit code.
+    def run(self, args, stream):
+        project_dir = self.project_dir()
+        args = args + ["--project-dir", project_dir, "--profiles-dir", project_dir]
+        os.chdir(project_dir)
+
+        if dbtRunner is None:
+            process = subprocess.Popen(
+                ["dbt"] + args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+            )
+            for line in process.stdout:
+                stream(line)
+            return process.wait()
+
+        def callback(event):
+            if event.info.level in ["info", "warn", "error"]:
+                stream(event.info.msg + "\n")
+
+        parse_args = get_parse_args(args)
+        manifest = self.manifests.get(tuple(parse_args))
+        if manifest is None:
+            result = dbtRunner().invoke(
+                ["parse", "--project-dir", project_dir, "--profiles-dir", project_dir]
+                + parse_args
+            )
+            if not result.success:
+                stream("dbt parse failed: {}\n".format(result.exception))
+                return 2
+            manifest = result.result
+            self.manifests[tuple(parse_args)] = manifest
+        result = dbtRunner(manifest=manifest, callbacks=[callback]).invoke(args)
+        if result.exception is not None:
+            stream("{}\n".format(result.exception))
+            return 2
+        return 0 if result.success else 1
+
+
+class WorkerRequestHandler(BaseHTTPRequestHandler):
+    worker = None
+    token = None
+
+    def send_json(self, document, status=HTTPStatus.OK):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        authorization = self.headers.get("Authorization", "")
+        if hmac.compare_digest(authorization, "Bearer {}".format(self.token)):
+            return True
+        self.send_json({"message": "unauthorized"}, HTTPStatus.UNAUTHORIZED)
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path != "/status":
+            self.send_json({"message": "not found"}, HTTPStatus.NOT_FOUND)
+            return
+        self.send_json(
+            {
+                "busy": self.worker.lock.locked(),
+                "idle_seconds": int(time.time() - self.worker.last_activity),
+                "runs": self.worker.runs,
+                "project": self.worker.project,
+            }
+        )
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path != "/run":
+            self.send_json({"message": "not found"}, HTTPStatus.NOT_FOUND)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self.worker.is_valid_project(
+            request.get("project"), request.get("project_name")
+        ):
+            self.send_json({"message": "invalid project"}, HTTPStatus.BAD_REQUEST)
+            return
+
+        # a worker runs one dbt command at a time, yarn_dbt tries another worker
+        if not self.worker.lock.acquire(blocking=False):
+            self.send_json({"message": "busy"}, HTTPStatus.CONFLICT)
+            return
+        try:
+            # the output is streamed until the connection is closed
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.end_headers()
+
+            def stream(text):
+                self.wfile.write(text.encode())
+                self.wfile.flush()
+
+            try:
+                self.worker.renew_ticket()
+                self.worker.sync_project(request["project"], request["project_name"])
+                exit_code = self.worker.run(request["args"], stream)
+            except Exception as e:
+                logging.exception("dbt command failed")
+                stream("{}\n".format(e))
+                exit_code = 2
+            stream("{}{}\n".format(EXIT_CODE_MARKER, exit_code))
+        finally:
+            self.worker.runs += 1
+            self.worker.last_activity = time.time()
+            self.worker.lock.release()
+
+        # recycle the worker, yarn relaunches the container process
+        if self.worker.runs >= self.worker.options.max_runs:
+            logging.info("Recycling worker after %s runs", self.worker.runs)
+            threading.Thread(target=lambda: os._exit(0)).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run dbt commands for yarn_dbt.")
+    parser.add_argument("--port", type=int, default=7788)
+    parser.add_argument("--token-file", required=True)
+    parser.add_argument("--workdir", required=True)
+    parser.add_argument("--staging-dir", required=True)
+    parser.add_argument("--keytab", required=True)
+    parser.add_argument("--principal", required=True)
+    parser.add_argument("--max-runs", type=int, default=50)
+    options = parser.parse_args()
+
+    with open(options.token_file) as f:
+        WorkerRequestHandler.token = f.read().strip()
+    WorkerRequestHandler.worker = DbtWorker(options)
+    os.makedirs(options.workdir, exist_ok=True)
+
+    server = ThreadingHTTPServer(("", options.port), WorkerRequestHandler)
+    server.daemon_threads = True
+    logging.info("dbt worker listening on port %s", options.port)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
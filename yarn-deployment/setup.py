@@ -43,10 +43,16 @@ setup(
     install_requires=[
         "python-dotenv",      
 	"requests_gssapi",
+        "gssapi",
     ],
+    extras_require={
+        "build-env": ["venv-pack"],
+        "zstd": ["zstandard"],
+        "lz4": ["lz4"],
+    },
     py_modules=[],
     python_requires=">=3.8",
-    scripts=['yarn_dbt.py'],
+    scripts=['yarn_dbt.py', 'dbt_docs_server.py', 'dbt_worker.py', 'dbt_log_index.py'],
     entry_points={
         "console_scripts": ["yarn_dbt = yarn_dbt:main"],
     },
@@ -14,18 +14,51 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fcntl
+import fnmatch
+import gssapi
+import gzip
+import hashlib
 import json
 import logging
+import math
+import multiprocessing
 import os
+import re
 import requests
+import secrets
+import shlex
+import shutil
 import subprocess
 import socket
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import uuid
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from dotenv import dotenv_values
+from requests.adapters import HTTPAdapter
 from requests_gssapi import HTTPSPNEGOAuth
+from urllib3.util.retry import Retry
+
+try:
+    import venv_pack
+except ImportError:
+    venv_pack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 # default log level warning
 LOGLEVEL = os.environ.get("LOGLEVEL", "WARNING").upper()
@@ -35,34 +68,199 @@ logging.basicConfig(level=LOGLEVEL, format="%(asctime)s - %(levelname)s: %(messa
 # Global dictionary to store all environment variables.
 ENV_VARIABLES = None
 
+# Global requests session to the ResourceManager and NodeManager REST apis.
+YARN_SESSION = None
+
+# Python dependencies artifact and its cache key, looked up once per process.
+DEPENDENCIES_ARTIFACT = None
+
+# Service user keytab, looked up once per process.
+SERVICE_USER_KEYTAB = None
+
+# Directory for the local state of yarn_dbt on the gateway machine.
+YARN_DBT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".yarn_dbt")
+
+# Directory of the compressed dbt project, every project of a batch gets its own.
+PROJECT_ARCHIVE_DIR = os.path.expanduser("~")
+
+# dbt docs artifacts published by the docs generation container
+DBT_DOCS_ARTIFACTS = ["index.html", "manifest.json", "catalog.json"]
+
+# static file server for the dbt docs, shipped to the dbt-service container
+DBT_DOCS_SERVER = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "dbt_docs_server.py"
+)
+
+# warm dbt worker, shipped to the dbt-worker containers
+DBT_WORKER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "dbt_worker.py")
+
+# compresses and indexes the dbt log, shipped to the yarn containers
+DBT_LOG_INDEXER = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "dbt_log_index.py"
+)
+
+# dbt log levels in order of severity
+DBT_LOG_LEVELS = ["debug", "info", "warn", "error"]
+
+# last line of the output streamed by a dbt worker, carries the dbt exit code
+DBT_WORKER_EXIT_CODE_MARKER = "yarn_dbt_worker_exit_code: "
+
+# runs the dbt command in the yarn container and reports the peak memory in kilobytes,
+# the cpu seconds and the wall clock seconds of dbt for the sizing history
+RESOURCE_USAGE_WRAPPER = 'import resource, subprocess, sys, time; start = time.time(); code = subprocess.call(sys.argv[1:]); usage = resource.getrusage(resource.RUSAGE_CHILDREN); print("yarn_dbt resource usage:", usage.ru_maxrss, usage.ru_utime + usage.ru_stime, time.time() - start, flush=True); sys.exit(code)'
+
+# file extension of the compressed dbt project for every supported codec
+PROJECT_ARCHIVE_EXTENSIONS = {"gzip": "tar.gz", "zstd": "tar.zst", "lz4": "tar.lz4"}
+
 commands = ["debug", "run", "seed", "test", "snapshot"]
 docs = ["docs"]
+build_env = ["build-env"]
+submit = ["submit"]
+app_commands = ["status", "wait", "kill"]
+worker = ["worker"]
+retry = ["retry"]
+logs = ["logs"]
+batch = ["batch"]
 
 
 def main():
     args = sys.argv
     print(args)
     if len(args) <= 1:
-        print("usage: yarn_dbt [run|debug|seed|test|snapshot|docs]")
+        print(
+            "usage: yarn_dbt [run|debug|seed|test|snapshot|docs|build-env] [--follow] [--slim]"
+        )
+        print("       yarn_dbt run --shards <number of containers>")
+        print("       yarn_dbt submit [run|debug|seed|test|snapshot]")
+        print("       yarn_dbt [status|wait|kill] <application id>...")
+        print("       yarn_dbt worker [start|stop|status]")
+        print("       yarn_dbt retry <application id> [--follow]")
+        print(
+            "       yarn_dbt logs <application id> [--node <node>] [--level debug|info|warn|error]"
+        )
+        print("       yarn_dbt batch <batch spec json>")
         sys.exit(10)
 
+    # options consumed by yarn_dbt, everything else is passed on to dbt
+    follow = pop_option("--follow")
+    slim = pop_option("--slim")
+    shards = pop_option_value("--shards")
+
     # load and fetch the environment variables needed for launching a yarn container
     load_fetch_environment_variables()
 
     if sys.argv[1] in commands:
         print("Running dbt commands: ")
         perform_user_authorization("headless_user")
-        launch_yarn_container_with_dbt_command()
+        if shards:
+            if sys.argv[1] != "run":
+                print("Option --shards is only supported for: run")
+                sys.exit(10)
+            if slim:
+                print("Option --slim can't be combined with --shards")
+                sys.exit(10)
+            run_dbt_shards(int(shards))
+        else:
+            # run on a warm dbt worker when the worker service is up, slim runs need
+            # the dbt state that only yarn containers fetch
+            use_worker = ENV_VARIABLES["DBT_WORKER_ENABLED"].lower() == "true"
+            if not (use_worker and not slim and run_dbt_on_worker(sys.argv[1:])):
+                launch_yarn_container_with_dbt_command(follow, slim)
 
     elif sys.argv[1] in docs:
         print("Running dbt_docs: ")
-        # perform user authorization for running yarn commands
+        # the docs are generated as the headless user and served as the service user
+        perform_user_authorization("headless_user")
+        docs_path = generate_dbt_docs()
         perform_user_authorization("service_user")
-        host_dbt_docs()
+        host_dbt_docs(docs_path)
+
+    elif sys.argv[1] in build_env:
+        print("Building dbt python environment: ")
+        perform_user_authorization("headless_user")
+        build_python_environment()
+
+    elif sys.argv[1] in submit:
+        # the remaining arguments are the dbt command
+        sys.argv.pop(1)
+        if len(sys.argv) <= 1 or sys.argv[1] not in commands:
+            print("usage: yarn_dbt submit [run|debug|seed|test|snapshot]")
+            sys.exit(10)
+        perform_user_authorization("headless_user")
+        submit_yarn_container_with_dbt_command(slim=slim)
+
+    elif sys.argv[1] in app_commands:
+        yarn_ids = sys.argv[2:]
+        if not yarn_ids:
+            print("usage: yarn_dbt [status|wait|kill] <application id>...")
+            sys.exit(10)
+        perform_user_authorization("headless_user")
+        if sys.argv[1] == "status":
+            print_yarn_app_status(yarn_ids)
+        elif sys.argv[1] == "wait":
+            wait_for_yarn_apps(yarn_ids)
+        else:
+            kill_yarn_apps(yarn_ids)
+    elif sys.argv[1] in worker:
+        if len(sys.argv) != 3 or sys.argv[2] not in ["start", "stop", "status"]:
+            print("usage: yarn_dbt worker [start|stop|status]")
+            sys.exit(10)
+        perform_user_authorization("headless_user")
+        if sys.argv[2] == "start":
+            start_dbt_workers()
+        elif sys.argv[2] == "stop":
+            try:
+                destroy_yarn_service(get_worker_service_name())
+            except requests.RequestException as e:
+                logging.critical("There was an error stopping the dbt workers.")
+                print(e)
+                sys.exit(10)
+        else:
+            print_dbt_worker_status()
+    elif sys.argv[1] in retry:
+        if len(sys.argv) != 3:
+            print("usage: yarn_dbt retry <application id> [--follow]")
+            sys.exit(10)
+        perform_user_authorization("headless_user")
+        retry_failed_dbt_nodes(sys.argv[2], follow)
+    elif sys.argv[1] in logs:
+        node = pop_option_value("--node")
+        level = pop_option_value("--level") or "info"
+        if len(sys.argv) != 3 or level not in DBT_LOG_LEVELS:
+            print(
+                "usage: yarn_dbt logs <application id> [--node <node>] [--level debug|info|warn|error]"
+            )
+            sys.exit(10)
+        perform_user_authorization("headless_user")
+        print_dbt_logs(sys.argv[2], node, level)
+    elif sys.argv[1] in batch:
+        if len(sys.argv) != 3:
+            print("usage: yarn_dbt batch <batch spec json>")
+            sys.exit(10)
+        perform_user_authorization("headless_user")
+        run_dbt_batch(sys.argv[2])
     else:
         print("Option not supported: " + sys.argv[1])
 
 
+# Remove a yarn_dbt option from the command line so that it isn't passed on to dbt.
+def pop_option(option):
+    if option in sys.argv[1:]:
+        sys.argv.remove(option)
+        return True
+    return False
+
+
+# Remove a yarn_dbt option and its value from the command line, returns the value.
+def pop_option_value(option):
+    if option in sys.argv[1:-1]:
+        index = sys.argv.index(option)
+        value = sys.argv[index + 1]
+        del sys.argv[index : index + 2]
+        return value
+    return None
+
+
 # load the environment variables from yarn.env file
 def load_fetch_environment_variables():
     logging.info("Loading environment variables.")
@@ -105,127 +303,482 @@ def check_environment_variables(ENV_VARIABLES):
 
     # Below keys are optional. Set values incase user doesn't add these values.
     ENV_VARIABLES.setdefault("DBT_DOCS_PORT", "7777")
+    ENV_VARIABLES.setdefault("DBT_DOCS_CONTAINERS", "1")
+    ENV_VARIABLES.setdefault("DBT_WORKER_ENABLED", "false")
+    ENV_VARIABLES.setdefault("DBT_WORKER_PORT", "7788")
+    ENV_VARIABLES.setdefault("DBT_WORKER_MIN", "1")
+    ENV_VARIABLES.setdefault("DBT_WORKER_MAX", "4")
+    ENV_VARIABLES.setdefault("DBT_WORKER_IDLE_TIMEOUT", "900")
+    ENV_VARIABLES.setdefault("DBT_WORKER_MAX_RUNS", "50")
     ENV_VARIABLES.setdefault("YARN_CONTAINER_MEMORY", "2048")
+    ENV_VARIABLES.setdefault("YARN_CONTAINER_VCORES", "1")
+    ENV_VARIABLES.setdefault("YARN_SIZING_MODE", "suggest")
+    ENV_VARIABLES.setdefault("YARN_SIZING_PERCENTILE", "95")
+    ENV_VARIABLES.setdefault("YARN_SIZING_HEADROOM_PERCENT", "25")
+    ENV_VARIABLES.setdefault("YARN_SIZING_MIN_RUNS", "3")
+    ENV_VARIABLES.setdefault("YARN_SIZING_OVERHEAD_MB", "1024")
+    ENV_VARIABLES.setdefault("YARN_SIZING_MIN_MEMORY", "1024")
+    ENV_VARIABLES.setdefault("YARN_SIZING_HISTORY_RUNS", "20")
     ENV_VARIABLES.setdefault("YARN_TIMEOUT", "1800000")
     ENV_VARIABLES.setdefault("APPLICATION_TAGS", "yarn-dbt")
-    
+    ENV_VARIABLES.setdefault("YARN_FOLLOW_INTERVAL", "2")
+    ENV_VARIABLES.setdefault("YARN_POLL_INTERVAL", "5")
+    ENV_VARIABLES.setdefault("DBT_ARTIFACTS_PATH_HDFS", "/tmp/yarn-dbt-artifacts")
+    ENV_VARIABLES.setdefault("DBT_PARTIAL_PARSE_CACHE_ENABLED", "true")
+    ENV_VARIABLES.setdefault(
+        "DBT_PARTIAL_PARSE_PATH_HDFS", "/tmp/yarn-dbt-partial-parse"
+    )
+    ENV_VARIABLES.setdefault("DBT_PARTIAL_PARSE_RETENTION_DAYS", "7")
+    ENV_VARIABLES.setdefault("DBT_STATE_PATH_HDFS", "/tmp/yarn-dbt-state")
+    ENV_VARIABLES.setdefault("YARN_BATCH_PARALLELISM", "4")
+    ENV_VARIABLES.setdefault("YARN_PACKAGING_CONCURRENCY", "2")
+    ENV_VARIABLES.setdefault("YARN_RUN_FILES_RETENTION_HOURS", "24")
+    ENV_VARIABLES.setdefault(
+        "YARN_TIMING_REPORT_DIR", os.path.join(YARN_DBT_STATE_DIR, "reports")
+    )
+    ENV_VARIABLES.setdefault("YARN_TIMING_REPORT_RETENTION_DAYS", "7")
+    ENV_VARIABLES.setdefault("YARN_TIMING_PROMETHEUS_FILE", "")
+    ENV_VARIABLES.setdefault("KERBEROS_CCACHE_DIR", "/tmp")
+    ENV_VARIABLES.setdefault("KERBEROS_RENEW_MARGIN", "600")
+    ENV_VARIABLES.setdefault("YARN_SHIP_TICKET_CACHE", "false")
+    ENV_VARIABLES.setdefault("DEPENDENCIES_ENV_NAME", "dbt-env.tar.gz")
+    ENV_VARIABLES.setdefault("DBT_PROJECT_IGNORE", "target,logs")
+    ENV_VARIABLES.setdefault("DBT_PROJECT_CODEC", "gzip")
+    ENV_VARIABLES.setdefault("WEBHDFS_URI", "")
+    ENV_VARIABLES.setdefault("DBT_PROJECT_STAGING_HDFS", "/tmp/yarn-dbt-staging")
+    ENV_VARIABLES.setdefault("DBT_PROJECT_STAGING_RETENTION_DAYS", "7")
+    ENV_VARIABLES.setdefault("DBT_PROJECT_UPLOAD_CHUNK_MB", "64")
+    ENV_VARIABLES.setdefault("DBT_PROJECT_UPLOAD_THREADS", "4")
+    ENV_VARIABLES.setdefault("YARN_VENV_CACHE_ENABLED", "true")
+    ENV_VARIABLES.setdefault("YARN_VENV_CACHE_DIR", "/tmp/dbt-venv-cache")
+    ENV_VARIABLES.setdefault("YARN_VENV_CACHE_MAX_SIZE_MB", "5120")
+
+    if ENV_VARIABLES["YARN_SIZING_MODE"] not in ["off", "suggest", "apply"]:
+        logging.critical(
+            "Unsupported YARN_SIZING_MODE %s, expected one of off, suggest, apply",
+            ENV_VARIABLES["YARN_SIZING_MODE"],
+        )
+        sys.exit(10)
+
+    if ENV_VARIABLES["DBT_PROJECT_CODEC"] not in PROJECT_ARCHIVE_EXTENSIONS:
+        logging.critical(
+            "Unsupported DBT_PROJECT_CODEC %s, expected one of %s",
+            ENV_VARIABLES["DBT_PROJECT_CODEC"],
+            list(PROJECT_ARCHIVE_EXTENSIONS),
+        )
+        sys.exit(10)
 
-# Perform kerberos authorization in gateway machine
+
+# Perform kerberos authorization in gateway machine. Every principal gets its own
+# credential cache and a ticket that is still valid for KERBEROS_RENEW_MARGIN seconds is
+# reused instead of requesting a new one from the KDC.
 def perform_user_authorization(user_type):
     if user_type == "service_user":
         # get hostname
         host = socket.gethostname()
+        principal = "{}/{}".format(ENV_VARIABLES["DBT_SERVICE_USER"], host)
+    else:
+        principal = ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"]
+
+    # the hadoop commands and the REST calls pick up the credential cache from here
+    credential_cache = "FILE:{}".format(get_credential_cache(principal))
+    if os.environ.get("KRB5CCNAME") != credential_cache:
+        # the SPNEGO cookies of the yarn session belong to the previous principal
+        global YARN_SESSION
+        YARN_SESSION = None
+    os.environ["KRB5CCNAME"] = credential_cache
+    if has_valid_ticket(principal):
+        logging.info("Reusing kerberos ticket of %s", principal)
+        return
+
+    if user_type == "service_user":
         keytab_path = get_service_user_keytab()
         logging.info("Found keytab file %s", keytab_path)
-
-        # perform authorization for service user
-        subprocess.run(
-            [
-                "kinit",
-                "-kt",
-                keytab_path,
-                "{}/{}".format(ENV_VARIABLES["DBT_SERVICE_USER"], host),
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
     else:
-        # perform authorization using headless keytab
-        subprocess.run(
-            [
-                "kinit",
-                "-kt",
-                ENV_VARIABLES["DBT_HEADLESS_KEYTAB"],
-                ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"],
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
+        keytab_path = ENV_VARIABLES["DBT_HEADLESS_KEYTAB"]
+
+    # perform authorization for the principal using its keytab
+    subprocess.run(
+        ["kinit", "-kt", keytab_path, principal],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+# Path of the kerberos credential cache of a principal on the gateway machine.
+def get_credential_cache(principal):
+    return os.path.join(
+        ENV_VARIABLES["KERBEROS_CCACHE_DIR"],
+        "krb5cc_yarn_dbt_{}_{}".format(
+            os.getuid(), hashlib.sha256(principal.encode()).hexdigest()[:12]
+        ),
+    )
+
+
+# Check if the current credential cache holds a ticket of the principal that is valid
+# for at least the renew margin.
+def has_valid_ticket(principal):
+    try:
+        credentials = gssapi.Credentials(
+            name=gssapi.Name(principal, gssapi.NameType.kerberos_principal),
+            usage="initiate",
         )
+        lifetime = credentials.lifetime
+    except gssapi.exceptions.GSSError:
+        return False
+    return lifetime is None or lifetime > int(ENV_VARIABLES["KERBEROS_RENEW_MARGIN"])
 
 
-# get the yarn service user keytab distributed to all the nodes by cloudera scm agent
+# get the yarn service user keytab distributed to all the nodes by cloudera scm agent.
+# The lookup is memoized in-process and in a small on-disk cache that stays valid as
+# long as neither the keytab nor the process directory changed.
 def get_service_user_keytab():
+    global SERVICE_USER_KEYTAB
+    if SERVICE_USER_KEYTAB is not None:
+        return SERVICE_USER_KEYTAB
+
     service_name = "{}.keytab".format(ENV_VARIABLES["DBT_SERVICE_USER"])
     search_path = "/var/run/cloudera-scm-agent/process/"
+    cache_path = os.path.join(YARN_DBT_STATE_DIR, "keytab_cache.json")
+
+    try:
+        search_path_mtime = os.stat(search_path).st_mtime_ns
+    except OSError:
+        search_path_mtime = None
+
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if (
+            cache["service_name"] == service_name
+            and cache["search_path_mtime"] == search_path_mtime
+            and os.stat(cache["keytab"]).st_mtime_ns == cache["keytab_mtime"]
+        ):
+            SERVICE_USER_KEYTAB = cache["keytab"]
+            return SERVICE_USER_KEYTAB
+    except (OSError, ValueError, KeyError):
+        pass
+
+    keytab_path = find_service_user_keytab(search_path, service_name)
+    if keytab_path is None:
+        logging.critical(
+            "Couldn't find service keytab {} in location".format(service_name)
+            + search_path
+        )
+        sys.exit(10)
+
+    try:
+        os.makedirs(YARN_DBT_STATE_DIR, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(
+                {
+                    "service_name": service_name,
+                    "keytab": keytab_path,
+                    "keytab_mtime": os.stat(keytab_path).st_mtime_ns,
+                    "search_path_mtime": search_path_mtime,
+                },
+                f,
+            )
+    except OSError as e:
+        logging.warning("Couldn't write keytab cache %s: %s", cache_path, e)
+
+    SERVICE_USER_KEYTAB = keytab_path
+    return SERVICE_USER_KEYTAB
+
+
+# Search the top level process directories of the cloudera scm agent for the service
+# keytab. Directories of the service roles are searched first and newer processes,
+# which have a higher id prefix, before older ones.
+def find_service_user_keytab(search_path, service_name):
+    try:
+        process_dirs = os.listdir(search_path)
+    except OSError:
+        return None
+
+    role_marker = "-{}-".format(ENV_VARIABLES["DBT_SERVICE_USER"].lower())
+
+    def process_dir_order(process_dir):
+        process_id = process_dir.split("-", 1)[0]
+        return (
+            role_marker in process_dir.lower(),
+            int(process_id) if process_id.isdigit() else -1,
+        )
+
+    for process_dir in sorted(process_dirs, key=process_dir_order, reverse=True):
+        keytab_path = os.path.join(search_path, process_dir, service_name)
+        if os.path.isfile(keytab_path):
+            return keytab_path
+    return None
 
-    # search for service keytab path
-    for dirpath, dirname, filename in os.walk(search_path):
-        if service_name in filename:
-            return os.path.join(dirpath, service_name)
 
-    logging.critical(
-        "Couldn't find service keytab {} in location".format(service_name) + search_path
+# Wrap a shell command with start/end markers so that every phase of the container
+# bootstrap shows up with a timestamp in the yarn container logs.
+def generate_phase_command(app_name, phase, command):
+    # every marker is written at once, so that markers of concurrent phases don't mix
+    return "echo \"{0}: {1} start: $(date +'%Y-%m-%d:%H:%M:%S.%3N%z')\" && {2} && echo \"{0}: {1} end: $(date +'%Y-%m-%d:%H:%M:%S.%3N%z')\"".format(
+        app_name,
+        phase,
+        command,
     )
-    sys.exit(10)
 
 
-def generate_yarn_shell_command(app_name):
-    # Perform kerberos authorization inside yarn container
-    kinit_start = "echo -n '{}: Kinit start: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+# Generate the shell command that runs a command in the background while another runs
+# in the foreground. It waits for both and succeeds only when both succeeded.
+def generate_concurrent_command(background_command, foreground_command):
+    return "{{ ( {} ) & background_pid=$! ; {} ; foreground_exit_code=$? ; wait $background_pid && [ $foreground_exit_code -eq 0 ] ; }}".format(
+        background_command,
+        foreground_command,
     )
 
-    # find keytab path and hostname for gateway machine
-    kinit_command = "kinit -kt {} {}".format(
-        ENV_VARIABLES["DBT_HEADLESS_KEYTAB"],
-        ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"],
+
+# Find the python dependencies artifact that yarn containers should install. A packed
+# environment published by `yarn_dbt build-env` is preferred over the wheel bundle. The
+# artifact is returned together with a content based key derived from its HDFS checksum,
+# which names the ready made virtualenv in the node local cache of yarn containers.
+def get_dependencies_artifact():
+    global DEPENDENCIES_ARTIFACT
+    if DEPENDENCIES_ARTIFACT is None:
+        DEPENDENCIES_ARTIFACT = find_dependencies_artifact()
+    return DEPENDENCIES_ARTIFACT
+
+
+def find_dependencies_artifact():
+    artifacts = [
+        ENV_VARIABLES["DEPENDENCIES_ENV_NAME"],
+        ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"],
+    ]
+    artifact_paths = [
+        "{}/{}".format(ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"], artifact)
+        for artifact in artifacts
+    ]
+
+    # missing artifacts are reported on stderr, checksums of the others on stdout.
+    result = subprocess.run(
+        ["hdfs", "dfs", "-checksum"] + artifact_paths,
+        capture_output=True,
+        text=True,
     )
-    kinit_end = "echo -n '{}: Kinit end: '; date +'%Y-%m-%d:%H:%M:%S'".format(app_name)
 
-    # Create a scratch directory for working with dbt project in container
-    working_dir = "/tmp/dbt-{}".format(datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S"))
-    create_working_dir_start = "echo -n '{}: Create working directory start: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+    # checksum output format: <path> <algorithm> <checksum>
+    checksums = {}
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            checksums[os.path.basename(fields[0])] = fields[2]
+
+    for artifact in artifacts:
+        if artifact in checksums:
+            key = hashlib.sha256(
+                "{}:{}".format(artifact, checksums[artifact]).encode()
+            ).hexdigest()[:16]
+            logging.debug("Python dependencies artifact %s with key %s", artifact, key)
+            return artifact, key
+
+    logging.warning(
+        "Couldn't compute checksum of %s, virtualenv cache disabled: %s",
+        artifact_paths,
+        result.stderr,
     )
-    create_working_dir_command = "mkdir -p {} && tar -zxf {} --directory {} && cd {} && python3 -m venv {}/dbt-venv".format(
-        working_dir,
-        "dbt-workspace.tar.gz",
-        working_dir,
-        working_dir,
-        working_dir,
+    return ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"], None
+
+
+# Generate the phases that install the python dependencies artifact into a virtualenv
+# at <target_dir>/dbt-venv. When the NodeManager already localized and unpacked the
+# artifact into localized_dir, it isn't downloaded from HDFS again.
+def generate_install_phases(target_dir, artifact, localized_dir=None):
+    if artifact == ENV_VARIABLES["DEPENDENCIES_ENV_NAME"]:
+        if localized_dir:
+            copy_python_environment = (
+                "mkdir -p {0}/dbt-venv && cp -R {1}/. {0}/dbt-venv".format(
+                    target_dir,
+                    localized_dir,
+                )
+            )
+            return [("Copy python environment", copy_python_environment)]
+
+        # packed environment is relocatable and only needs to be unpacked, it is
+        # streamed from HDFS into tar without a temporary copy on local disk
+        unpack_python_environment = "mkdir -p {0}/dbt-venv && hdfs dfs -cat {1}/{2} | tar -zxf - --directory {0}/dbt-venv".format(
+            target_dir,
+            ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"],
+            artifact,
+        )
+        return [("Download python environment", unpack_python_environment)]
+
+    phases = []
+    dependencies_dir = "{}/dependencies".format(localized_dir or target_dir)
+    if not localized_dir:
+        # Stream python dependencies from HDFS into the local container
+        download_python_dependencies_from_hdfs = (
+            "mkdir -p {2} && hdfs dfs -cat {0}/{1} | tar -zxf - --directory {2}".format(
+                ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"],
+                artifact,
+                target_dir,
+            )
+        )
+        phases.append(
+            ("Download python dependencies", download_python_dependencies_from_hdfs)
+        )
+
+    # Install python dependencies in local container
+    populate_working_dir_command = "python3 -m venv {0}/dbt-venv && cd {1} && {0}/dbt-venv/bin/pip install * -q -f ./ --no-index && cd {0} && rm -rf {0}/dependencies".format(
+        target_dir,
+        dependencies_dir,
     )
-    create_working_dir_end = "echo -n '{}: Create working directory end: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+    phases.append(("Install python dependencies", populate_working_dir_command))
+    return phases
+
+
+# Check if the NodeManager can unpack an archive natively when localizing it.
+def is_native_archive(path):
+    return path.lower().endswith((".tar.gz", ".tgz", ".tar", ".zip", ".jar"))
+
+
+# Generate the shell command that looks up a ready made virtualenv in the node local
+# cache and builds it on a cache miss. Cache entries are protected by flock: an entry is
+# built under an exclusive lock and held with a shared lock while dbt runs, so that the
+# LRU eviction never removes a virtualenv that is in use by another container. The cache
+# directory is shared by all users like /tmp. When it can't be used, the virtualenv is
+# built in the container directory instead.
+def generate_venv_cache_command(artifact, cache_key, localized_dir=None):
+    cache_dir = "$venv_cache_dir"
+    cache_entry = "{}/{}".format(cache_dir, cache_key)
+
+    build_venv_command = (
+        "rm -rf {0} && mkdir -p {0} && {1} && touch {0}/.complete".format(
+            cache_entry,
+            " && ".join(
+                command
+                for phase, command in generate_install_phases(
+                    cache_entry, artifact, localized_dir
+                )
+            ),
+        )
     )
 
-    # Download python dependencies from HDFS to local container
-    download_python_dependencies_start = "echo -n '{}: Download python dependencies start: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+    lookup_venv_command = 'venv_cache_dir={3}/$(id -un) && {{ {{ mkdir -p -m 1777 {3} && mkdir -p {0} ; }} 2>/dev/null || {{ echo "Virtualenv cache {3} unavailable" && venv_cache_dir=$container_dir/venv-cache && mkdir -p {0} ; }} ; }} && exec 9>{1}.lock && flock -x 9 && ( [ -f {1}/.complete ] && echo "Virtualenv cache hit: {1}" || ( echo "Virtualenv cache miss: {1}" && {2} ) ) && flock -s 9 && touch {1}/.last_used'.format(
+        cache_dir,
+        cache_entry,
+        build_venv_command,
+        ENV_VARIABLES["YARN_VENV_CACHE_DIR"],
     )
-    download_python_dependencies_from_hdfs = (
-        "hdfs dfs -copyToLocal {}/{} {} && tar -zxf {}/{} --directory {}".format(
-            ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"],
-            ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"],
-            working_dir,
-            working_dir,
-            ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"],
-            working_dir,
-        )
+
+    # evict least recently used entries until the cache fits in the size limit. Entries
+    # locked by running containers are skipped.
+    evict_venv_command = "( flock -n 8 || exit 0; for marker in $(ls -1tr {0}/*/.last_used 2>/dev/null); do [ $(du -sm {0} | cut -f1) -le {1} ] && break; entry=$(dirname $marker); [ $entry = {2} ] && continue; flock -n -x $entry.lock rm -rf $entry; done ) 8>{0}/.evict.lock".format(
+        cache_dir,
+        ENV_VARIABLES["YARN_VENV_CACHE_MAX_SIZE_MB"],
+        cache_entry,
     )
-    download_python_dependencies_end = "echo -n '{}: Download python dependencies end: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+
+    return lookup_venv_command, evict_venv_command, "{}/dbt-venv".format(cache_entry)
+
+
+# Generate the phases that prepare the python environment for dbt inside a yarn
+# container and return them together with the path of the resulting virtualenv.
+def generate_python_environment_phases(working_dir, localized_dir=None):
+    artifact, cache_key = get_dependencies_artifact()
+    if ENV_VARIABLES["YARN_VENV_CACHE_ENABLED"].lower() != "true":
+        cache_key = None
+
+    if not cache_key:
+        return generate_install_phases(
+            working_dir, artifact, localized_dir
+        ), "{}/dbt-venv".format(working_dir)
+
+    # Reuse the virtualenv from the node local cache
+    lookup_venv_command, evict_venv_command, venv_dir = generate_venv_cache_command(
+        artifact, cache_key, localized_dir
     )
+    phases = [
+        ("Lookup python virtualenv cache", lookup_venv_command),
+        ("Evict python virtualenv cache", evict_venv_command),
+    ]
+    return phases, venv_dir
 
-    # Install python dependencies in local container
-    populate_working_dir_command_start = "echo -n '{}: Install python dependencies start: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+
+def generate_yarn_shell_command(app_name, dbt_args=None, artifacts=(), slim=False):
+    if dbt_args is None:
+        dbt_args = sys.argv[1:]
+
+    # Create a scratch directory for working with dbt project in container
+    working_dir = "/tmp/{}".format(app_name)
+    target_dir = "{}/{}/target".format(working_dir, ENV_VARIABLES["DBT_PROJECT_NAME"])
+    artifacts_dir = "{}/{}".format(ENV_VARIABLES["DBT_ARTIFACTS_PATH_HDFS"], app_name)
+
+    # Perform kerberos authorization inside yarn container
+    kinit_command = "kinit -kt {} {}".format(
+        ENV_VARIABLES["DBT_HEADLESS_KEYTAB"],
+        ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"],
     )
-    populate_working_dir_command = "source {}/dbt-venv/bin/activate && cd {}/dependencies && {}/dbt-venv/bin/pip install * -q -f ./ --no-index".format(
-        working_dir,
+    if ENV_VARIABLES["YARN_SHIP_TICKET_CACHE"].lower() == "true":
+        # use the ticket localized from the gateway while it is valid
+        ticket_cache = os.path.basename(
+            get_credential_cache(ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"])
+        )
+        kinit_command = "if klist -s FILE:$PWD/{0}; then export KRB5CCNAME=FILE:$PWD/{0}; else {1}; fi".format(
+            ticket_cache,
+            kinit_command,
+        )
+    phases = [("Kinit", kinit_command)]
+
+    # The dbt project is extracted while the python environment is set up
+    extract_project_command = generate_phase_command(
+        app_name,
+        "Extract dbt project",
+        generate_extract_command(
+            os.path.basename(get_compressed_project_directory()), working_dir
+        ),
+    )
+
+    # The partial parse state of a previous run is restored after the extraction. A
+    # copy is kept to tell whether dbt changed it.
+    partial_parse_path = get_partial_parse_path(dbt_args)
+    if partial_parse_path:
+        extract_project_command = "{} && {}".format(
+            extract_project_command,
+            generate_phase_command(
+                app_name,
+                "Restore dbt partial parse state",
+                "{{ hdfs dfs -get {0} {1}/partial_parse.restored 2>/dev/null && mkdir -p {2} && cp {1}/partial_parse.restored {2}/partial_parse.msgpack || true ; }}".format(
+                    partial_parse_path, working_dir, target_dir
+                ),
+            ),
+        )
+
+    # Slim runs compare the project against the dbt state of the last good run, which
+    # is the most recently published state of any user
+    state_dir = ENV_VARIABLES["DBT_STATE_PATH_HDFS"]
+    state_name = get_dbt_state_name(dbt_args)
+    if slim:
+        extract_project_command = "{} && {}".format(
+            extract_project_command,
+            generate_phase_command(
+                app_name,
+                "Fetch dbt state",
+                "{{ mkdir -p {2}/state && state=$(hdfs dfs -stat '%Y %n' '{0}/{1}.*.manifest.json' 2>/dev/null | sort -n | tail -1 | cut -d ' ' -f 2) && [ -n \"$state\" ] && state=${{state%.manifest.json}} && hdfs dfs -get {0}/$state.manifest.json {0}/$state.run_results.json {2}/state/ && mv {2}/state/$state.manifest.json {2}/state/manifest.json && mv {2}/state/$state.run_results.json {2}/state/run_results.json || true ; }}".format(
+                    state_dir, state_name, working_dir
+                ),
+            ),
+        )
+    python_environment_phases, venv_dir = generate_python_environment_phases(
+        working_dir
+    )
+    setup_python_environment_command = " && ".join(
+        generate_phase_command(app_name, phase, command)
+        for phase, command in python_environment_phases
+    )
+    create_working_dir_command = "mkdir -p {} && {} && cd {}".format(
         working_dir,
+        generate_concurrent_command(
+            extract_project_command, setup_python_environment_command
+        ),
         working_dir,
     )
-    populate_working_dir_command_end = "echo -n '{}: Install python dependencies end: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
-    )
+    phases.append(("Create working directory", create_working_dir_command))
 
     # Set environment variable for dbt deployment
-    set_environment_variables_start = "echo -n '{}: Setting env blob for deployment start: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
-    )
-
     DBT_DEPLOYMENT_ENV = {}
     DBT_DEPLOYMENT_ENV["env"] = "yarn"
     DBT_DEPLOYMENT_ENV["version"] = "1.2.0"
@@ -236,94 +789,244 @@ def generate_yarn_shell_command(app_name):
             dbt_env_json_string
         )
     )
-    set_environment_variables_end = "echo -n '{}: Setting env blob for deployment done: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+    phases.append(
+        ("Setting env blob for deployment", set_environment_variables_command)
     )
 
     # Run dbt command in local container
-    dbt_command_string = " ".join(sys.argv[1:])
-    run_dbt_command_start = (
-        "echo -n '{}: Dbt command start: '; date +'%Y-%m-%d:%H:%M:%S'".format(app_name)
-    )
-    dbt_command = (
-        "ls -lrt {} && cd {}/{} && {}/dbt-venv/bin/dbt {} --profiles-dir={}/{}".format(
-            working_dir,
-            working_dir,
-            ENV_VARIABLES["DBT_PROJECT_NAME"],
-            working_dir,
-            dbt_command_string,
-            working_dir,
-            ENV_VARIABLES["DBT_PROJECT_NAME"],
+    dbt_command_string = " ".join(dbt_args)
+    if slim:
+        slim_args = "--defer --state {}/state".format(working_dir)
+        if not has_node_selection(dbt_args):
+            slim_args = "--select state:modified+ " + slim_args
+        dbt_command_string += " $(if [ -f {0}/state/manifest.json ] ; then echo {1} ; else echo 'No dbt state found, running without state comparison' >&2 ; fi)".format(
+            working_dir, slim_args
         )
+    # dbt writes its log file as json lines
+    dbt_command = "export DBT_LOG_FORMAT_FILE=json && source {}/bin/activate && ls -lrt {} && cd {}/{} && python3 -c '{}' {}/bin/dbt {} --profiles-dir={}/{}".format(
+        venv_dir,
+        working_dir,
+        working_dir,
+        ENV_VARIABLES["DBT_PROJECT_NAME"],
+        RESOURCE_USAGE_WRAPPER,
+        venv_dir,
+        dbt_command_string,
+        working_dir,
+        ENV_VARIABLES["DBT_PROJECT_NAME"],
     )
-    run_dbt_command_end = (
-        "echo -n '{}: Dbt command end: '; date +'%Y-%m-%d:%H:%M:%S'".format(app_name)
+    phases.append(("Dbt command", dbt_command))
+
+    # Publish the compressed and indexed dbt log for `yarn_dbt logs`, only errors go to
+    # the container stderr. The whole log goes to stderr when it can't be published.
+    dbt_post_run_command = "{{ python3 $container_dir/dbt_log_index.py --log logs/dbt.log --output logs/dbt.log.gz --index logs/dbt.log.index.json --print-level error && hdfs dfs -mkdir -p {0} && hdfs dfs -put -f logs/dbt.log.gz logs/dbt.log.index.json {0} ; }} || cat logs/dbt.log >&2".format(
+        artifacts_dir
+    )
+    dbt_post_run = generate_phase_command(
+        app_name, "DBT post run log aggregation and cleanup", dbt_post_run_command
     )
 
-    # Aggregate logs and cleanup workspace.
-    dbt_post_run_start = "echo -n '{}: DBT post run log aggregation and cleanup start: '; date +'%Y-%m-%d:%H:%M:%S'".format(
-        app_name
+    # Save the partial parse state when dbt changed it and expire the saved states of the
+    # project that weren't updated within the retention period
+    dbt_save_partial_parse = "true"
+    if partial_parse_path:
+        partial_parse_dir = ENV_VARIABLES["DBT_PARTIAL_PARSE_PATH_HDFS"]
+        dbt_save_partial_parse = "if [ -f {0}/partial_parse.msgpack ] && ! cmp -s {0}/partial_parse.msgpack {1}/partial_parse.restored ; then {2} ; fi".format(
+            target_dir,
+            working_dir,
+            generate_phase_command(
+                app_name,
+                "Save dbt partial parse state",
+                "hdfs dfs -mkdir -p {0} && hdfs dfs -put -f {1}/partial_parse.msgpack {2} && hdfs dfs -stat '%Y %n' '{0}/{3}.*' | awk -v expiry=$(( ($(date +%s) - {4} * 86400) * 1000 )) '$1 < expiry {{ print \"{0}/\" $2 }}' | xargs -r hdfs dfs -rm -f -skipTrash".format(
+                    partial_parse_dir,
+                    target_dir,
+                    partial_parse_path,
+                    ENV_VARIABLES["DBT_PROJECT_NAME"],
+                    int(float(ENV_VARIABLES["DBT_PARTIAL_PARSE_RETENTION_DAYS"])),
+                ),
+            ),
+        )
+
+    # Publish the dbt state of successful runs that covered every modified model. The
+    # state of runs with their own node selection doesn't describe the warehouse.
+    dbt_publish_state = "true"
+    if dbt_args[0] == "run" and not has_node_selection(dbt_args):
+        dbt_publish_state = "if [ $dbt_exit_code -eq 0 ] ; then {} ; fi".format(
+            generate_phase_command(
+                app_name,
+                "Publish dbt state",
+                "cp {1}/manifest.json {2}/{3}.manifest.json && cp {1}/run_results.json {2}/{3}.run_results.json && hdfs dfs -put -f {2}/{3}.manifest.json {2}/{3}.run_results.json {0}".format(
+                    state_dir,
+                    target_dir,
+                    working_dir,
+                    "{}.{}".format(state_name, ENV_VARIABLES["CURRENT_DBT_USER"]),
+                ),
+            )
+        )
+
+    # Preserve the run results of failed runs together with the dbt arguments, so that
+    # `yarn_dbt retry` can run only the failed nodes
+    dbt_preserve_results = "if [ $dbt_exit_code -ne 0 ] ; then {} ; fi".format(
+        generate_phase_command(
+            app_name,
+            "Preserve dbt run results",
+            "echo {0} > {1}/yarn_dbt_args.json && hdfs dfs -mkdir -p {2} && hdfs dfs -put -f $(ls {3}/run_results.json {3}/manifest.json 2>/dev/null) {1}/yarn_dbt_args.json {2}".format(
+                shlex.quote(json.dumps(dbt_args)),
+                working_dir,
+                artifacts_dir,
+                target_dir,
+            ),
+        )
     )
-    dbt_post_run_command = "cat logs/dbt.log >&2"
-    dbt_post_run_end = "echo -n '{}: DBT post run log aggregation and cleanup end '; date +'%Y-%m-%d:%H:%M:%S'; rm -rf {}".format(
-        app_name,
+
+    # Publish dbt artifacts from the target directory to HDFS
+    dbt_publish_artifacts = "true"
+    if artifacts:
+        dbt_publish_artifacts = generate_phase_command(
+            app_name,
+            "Publish dbt artifacts",
+            "hdfs dfs -mkdir -p {} && hdfs dfs -put -f {} {}".format(
+                artifacts_dir,
+                " ".join(
+                    "{}/{}/target/{}".format(
+                        working_dir, ENV_VARIABLES["DBT_PROJECT_NAME"], artifact
+                    )
+                    for artifact in artifacts
+                ),
+                artifacts_dir,
+            ),
+        )
+
+    # commands are meant to sequentially after previous success except the post run commands that run regardless of dbt_command success/failure.
+    # The container exits with the status of the dbt command so that yarn reports failed runs.
+    # Failures of HDFS reads that are piped into tar fail the pipeline.
+    shell_command = "set -o pipefail ; container_dir=$PWD ; {} ; dbt_exit_code=$? ; {} ; {} ; {} ; {} ; {} ; rm -rf {} ; exit $dbt_exit_code".format(
+        " && ".join(
+            generate_phase_command(app_name, phase, command)
+            for phase, command in phases
+        ),
+        dbt_post_run,
+        dbt_save_partial_parse,
+        dbt_publish_state,
+        dbt_preserve_results,
+        dbt_publish_artifacts,
         working_dir,
     )
 
-    # commands are meant to sequentially after previous success except dbt_logs_command that runs regardless of dbt_command success/failure.
-    shell_command = "{} && {} && {} && {} && {} && {} && {} && {} && {} && {}  && {} && {} && {} && {} && {} && {} && {} && {} ; {} && {} && {}".format(
-        kinit_start,
-        kinit_command,
-        kinit_end,
-        create_working_dir_start,
-        create_working_dir_command,
-        create_working_dir_end,
-        download_python_dependencies_start,
-        download_python_dependencies_from_hdfs,
-        download_python_dependencies_end,
-        populate_working_dir_command_start,
-        populate_working_dir_command,
-        populate_working_dir_command_end,
-        set_environment_variables_start,
-        set_environment_variables_command,
-        set_environment_variables_end,
-        run_dbt_command_start,
-        dbt_command,
-        run_dbt_command_end,
-        dbt_post_run_start,
-        dbt_post_run_command,
-        dbt_post_run_end,
+    return shell_command
+
+
+# Return the hdfs path of the saved dbt partial parse state for a dbt invocation, or
+# None when it isn't cached. The state is keyed by the project configuration files, the
+# dbt profile and target, and the python dependencies artifact, which pins the dbt
+# version. dbt itself detects which project files changed since the state was saved.
+def get_partial_parse_path(dbt_args):
+    if ENV_VARIABLES["DBT_PARTIAL_PARSE_CACHE_ENABLED"].lower() != "true":
+        return None
+    if "--no-partial-parse" in dbt_args:
+        return None
+    artifact, cache_key = get_dependencies_artifact()
+    if not cache_key:
+        return None
+
+    digest = hashlib.sha256()
+    for name in ["dbt_project.yml", "profiles.yml", "packages.yml", "dependencies.yml"]:
+        path = os.path.join(ENV_VARIABLES["DBT_PROJECT_NAME"], name)
+        if os.path.isfile(path):
+            digest.update("{}:{}\n".format(name, hash_project_file(path)).encode())
+
+    return "{}/{}.{}.{}.{}.msgpack".format(
+        ENV_VARIABLES["DBT_PARTIAL_PARSE_PATH_HDFS"],
+        ENV_VARIABLES["DBT_PROJECT_NAME"],
+        digest.hexdigest()[:16],
+        get_dbt_profile_key(dbt_args),
+        cache_key,
     )
 
-    return shell_command
 
+# Identify the dbt profile and target a dbt invocation runs against.
+def get_dbt_profile_key(dbt_args):
+    profile = []
+    for index, arg in enumerate(dbt_args[:-1]):
+        if arg in ["--profile", "--target", "-t"]:
+            profile.append(dbt_args[index + 1])
+    return re.sub(r"[^A-Za-z0-9_-]", "_", "-".join(profile) or "default")
 
-def get_yarn_app_id(app_name):
-    # fetch all yarn applications
-    yarn_apps_list = subprocess.run(
-        [
-            "yarn",
-            "application",
-            "-list",
-            "-appStates",
-            "ALL",
-        ],
-        check=True,
-        stdout=subprocess.PIPE,
-        text=True,
+
+# Return the name of the dbt state of the project against the target of a dbt
+# invocation. Every user publishes the manifest.json and run_results.json of their last
+# good run as <name>.<user>.manifest.json and <name>.<user>.run_results.json directly in
+# the shared state directory, where users can only replace their own files.
+def get_dbt_state_name(dbt_args):
+    return "{}.{}".format(
+        ENV_VARIABLES["DBT_PROJECT_NAME"], get_dbt_profile_key(dbt_args)
     )
 
-    # filter the current application from list of all yarn apps
-    grep_appId = subprocess.run(
-        ["grep", app_name],
-        input=yarn_apps_list.stdout,
-        stdout=subprocess.PIPE,
-        check=True,
-        text=True,
+
+# Tell whether a dbt invocation selects its own nodes instead of the whole project.
+def has_node_selection(dbt_args):
+    return any(
+        arg in ["--select", "-s", "--models", "-m", "--exclude", "--selector"]
+        for arg in dbt_args
+    )
+
+
+# Return a requests session to the ResourceManager and NodeManager REST apis. The
+# session is shared for the whole process, so connections and the hadoop.auth cookies
+# negotiated through SPNEGO are reused between calls.
+def get_yarn_session():
+    global YARN_SESSION
+    if YARN_SESSION is None:
+        YARN_SESSION = requests.Session()
+        YARN_SESSION.auth = HTTPSPNEGOAuth(opportunistic_auth=True)
+        YARN_SESSION.verify = False
+        retries = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=None,
+        )
+        adapter = HTTPAdapter(pool_maxsize=16, max_retries=retries)
+        YARN_SESSION.mount("http://", adapter)
+        YARN_SESSION.mount("https://", adapter)
+    return YARN_SESSION
+
+
+def get_yarn_app_id(app_name, client_output="", started_time_begin=0, returncode=0):
+    # the distributed shell client logs the application id when submitting the app
+    match = re.search(r"application_\d+_\d+", client_output)
+    if match:
+        yarn_id = match.group(0)
+        logging.debug("Yarn application id: %s", yarn_id)
+        return yarn_id
+
+    # a client that failed without an application id failed before the submission
+    if returncode != 0:
+        logging.critical("There was an error submitting dbt command.")
+        print(client_output)
+        sys.exit(10)
+
+    # otherwise look up only the applications of the current user with the
+    # application tags that were started since the submission
+    # Rest Api doc: https://hadoop.apache.org/docs/stable/hadoop-yarn/hadoop-yarn-site/ResourceManagerRest.html#Cluster_Applications_API
+    response = get_yarn_session().get(
+        ENV_VARIABLES["YARN_RM_URI"] + "/ws/v1/cluster/apps",
+        params={
+            "user": ENV_VARIABLES["CURRENT_DBT_USER"],
+            "applicationTags": ENV_VARIABLES["APPLICATION_TAGS"].lower(),
+            "startedTimeBegin": started_time_begin,
+        },
+        timeout=30,
     )
+    response.raise_for_status()
+    yarn_apps = (response.json().get("apps") or {}).get("app", [])
+
+    # app names are unique per user and timestamp, match them exactly
+    yarn_apps = [yarn_app for yarn_app in yarn_apps if yarn_app["name"] == app_name]
+    if not yarn_apps:
+        logging.critical("Couldn't find yarn application %s", app_name)
+        sys.exit(10)
 
-    # get the yarn application id
-    yarn_id = grep_appId.stdout.split()[0]
+    yarn_id = max(yarn_apps, key=lambda yarn_app: yarn_app["startedTime"])["id"]
     logging.debug("Yarn application id: %s", yarn_id)
     return yarn_id
 
@@ -337,186 +1040,1879 @@ def print_yarn_logs(yarn_id, log_type):
         text=True,
     )
     print(yarn_logs.stdout)
+    return yarn_logs.stdout
 
 
-# Compress current dbt project to localize in yarn containers.
-def compress_project_directory():
-    logging.info(
-        "Compressing dbt project directory: %s/%s",
-        os.getcwd(),
-        ENV_VARIABLES["DBT_PROJECT_NAME"],
-    )
-    compressed_project_directory = os.path.expanduser("~/dbt-workspace.tar.gz")
-    result = subprocess.run(
-        [
-            "tar",
-            "-zcf",
-            compressed_project_directory,
-            ENV_VARIABLES["DBT_PROJECT_NAME"],
-        ],
-        check=True,
-        capture_output=True,
-        text=True,
-    )
-    logging.info("Done compressing dbt project directory.")
+# Split the output of `yarn logs` into the log contents of every container.
+def parse_aggregated_logs(yarn_logs_output):
+    container_logs = {}
+    for match in re.finditer(
+        r"Container: (\S+) on .*?\nLogContents:\n(.*?)\nEnd of LogType",
+        yarn_logs_output,
+        re.S,
+    ):
+        container_logs[match.group(1)] = match.group(2)
+    return container_logs
 
 
-def launch_yarn_container_with_dbt_command():
-    # generate unique app name based on current timestamp and dbt username
-    app_name = "dbt.{}.{}".format(
-        ENV_VARIABLES["CURRENT_DBT_USER"],
-        datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S"),
-    )
-    compressed_project_directory = os.path.expanduser("~/dbt-workspace.tar.gz")
+# List the running shell containers of a yarn application with their NodeManager web
+# address. The application master container is skipped.
+def get_yarn_app_containers(yarn_id):
+    session = get_yarn_session()
+    rm_uri = ENV_VARIABLES["YARN_RM_URI"]
 
-    logging.debug(
-        "%s",
-        "{}: Compress dbt project directory start: {}".format(
-            app_name, datetime.utcnow().strftime("%Y-%m-%d:%H-%M-%S")
+    response = session.get(
+        "{}/ws/v1/cluster/apps/{}/appattempts".format(rm_uri, yarn_id), timeout=30
+    )
+    response.raise_for_status()
+    app_attempts = (response.json().get("appAttempts") or {}).get("appAttempt", [])
+    if not app_attempts:
+        return {}
+
+    response = session.get(
+        "{}/ws/v1/cluster/apps/{}/appattempts/{}/containers".format(
+            rm_uri, yarn_id, app_attempts[-1]["appAttemptId"]
         ),
+        timeout=30,
     )
-
-    compress_project_directory()
-
-    logging.debug(
-        "%s",
-        "{}: Compress dbt project directory end: {}".format(
-            app_name, datetime.utcnow().strftime("%Y-%m-%d:%H-%M-%S")
+    response.raise_for_status()
+
+    containers = {}
+    for container in response.json().get("container", []):
+        if container["containerId"].endswith("_000001"):
+            continue
+        node_address = container["nodeHttpAddress"]
+        if not node_address.startswith("http"):
+            node_address = "http://" + node_address
+        containers[container["containerId"]] = node_address
+    return containers
+
+
+# Print the bytes of a container log file written since the given offset. The new
+# offset is returned.
+def print_container_log_since(node_address, container_id, log_type, offset):
+    session = get_yarn_session()
+
+    # Rest Api doc: https://hadoop.apache.org/docs/stable/hadoop-yarn/hadoop-yarn-site/NodeManager.html
+    response = session.get(
+        "{}/ws/v1/node/containers/{}/logs".format(node_address, container_id),
+        timeout=30,
+    )
+    response.raise_for_status()
+    log_size = 0
+    for logs_info in response.json():
+        for log_info in logs_info.get("containerLogInfo", []):
+            if log_info["fileName"] == log_type:
+                log_size = int(log_info["fileSize"])
+
+    if log_size <= offset:
+        return offset
+
+    # a positive size returns the first bytes of the log file, which don't change while
+    # the log grows, unlike the last bytes a negative size returns
+    response = session.get(
+        "{}/ws/v1/node/containerlogs/{}/{}".format(
+            node_address, container_id, log_type
         ),
+        params={"size": log_size},
+        timeout=30,
     )
-
-    shell_command = generate_yarn_shell_command(app_name)
-    logging.info("shell command generated: %s", shell_command)
-    logging.info(
-        "Starting to execute the DBT job in YARN using Distributed Shell App for appid: %s",
-        app_name,
+    response.raise_for_status()
+    content = response.content[offset:log_size]
+    sys.stdout.write(content.decode(errors="replace"))
+    sys.stdout.flush()
+    return offset + len(content)
+
+
+# Run the distributed shell client and tail the logs of the shell containers from the
+# NodeManagers while the job runs. Once the application is done, the remainder of
+# every log is printed from the aggregated logs. Returns the application id, the
+# aggregated logs, and the exit code and output of the client.
+def follow_yarn_logs(client_command, app_name, started_time_begin, log_type):
+    client = subprocess.Popen(
+        client_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
     )
 
-    try:
-        result = subprocess.run(
-            [
-                "hadoop",
-                "org.apache.hadoop.yarn.applications.distributedshell.Client",
-                "-jar",
-                ENV_VARIABLES["YARN_JAR"],
-                "-container_memory",
-                ENV_VARIABLES["YARN_CONTAINER_MEMORY"],
-                "-localize_files",
-                compressed_project_directory,
-                "-timeout",
-                ENV_VARIABLES["YARN_TIMEOUT"],
-                "-appname",
-                app_name,
-                "-application_tags",
-                ENV_VARIABLES["APPLICATION_TAGS"],
-                "-shell_command",
-                shell_command,
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-    except Exception as e:
-        logging.critical("There was an error completing dbt command.")
-        print(e)
-        sys.exit(10)
-
-    # Print to console the output from dbt
-    yarn_id = get_yarn_app_id(app_name)
-    print_yarn_logs(yarn_id, "prelaunch.out")
-    yarn_log_string = "yarn logs -applicationId {}".format(yarn_id)
-    print("To display all yarn container logs run command: ")
-    print(yarn_log_string, "\n")
-
+    # drain the client output in the background, it carries the application id
+    client_output = []
+    reader = threading.Thread(
+        target=lambda: client_output.extend(client.stdout), daemon=True
+    )
+    reader.start()
+
+    yarn_id = None
+    offsets = {}
+    while True:
+        finished = client.poll() is not None
+        if yarn_id is None:
+            match = re.search(r"application_\d+_\d+", "".join(client_output))
+            yarn_id = match.group(0) if match else None
+
+        if yarn_id is not None:
+            try:
+                containers = get_yarn_app_containers(yarn_id)
+                for container_id, node_address in containers.items():
+                    offsets[container_id] = print_container_log_since(
+                        node_address,
+                        container_id,
+                        log_type,
+                        offsets.get(container_id, 0),
+                    )
+            except requests.RequestException as e:
+                logging.debug("Couldn't fetch container logs: %s", e)
+
+        if finished:
+            break
+        time.sleep(int(ENV_VARIABLES["YARN_FOLLOW_INTERVAL"]))
+
+    reader.join()
+    client_output = "".join(client_output)
+    yarn_id = get_yarn_app_id(
+        app_name, client_output, started_time_begin, client.returncode
+    )
 
-# Upload dbt project to hdfs
-def copy_project_to_hdfs():
-    compressed_project_directory = os.path.expanduser("~/dbt-workspace.tar.gz")
-    subprocess.run(
-        [
-            "hdfs",
-            "dfs",
-            "-copyFromLocal",
-            "-f",
-            compressed_project_directory,
-            "/tmp",
-        ],
-        check=True,
+    # the logs of finished containers are only available once aggregated
+    yarn_logs = subprocess.run(
+        ["yarn", "logs", "-applicationId", yarn_id, "-log_files", log_type],
         capture_output=True,
         text=True,
     )
-    logging.info("Done Uploading dbt project to hdfs.")
+    for container_id, log in parse_aggregated_logs(yarn_logs.stdout).items():
+        if container_id.endswith("_000001"):
+            continue
+        log = log.encode()[offsets.get(container_id, 0) :]
+        sys.stdout.write(log.decode(errors="replace"))
+    sys.stdout.flush()
+
+    return yarn_id, yarn_logs.stdout, client.returncode, client_output
+
+
+# Parse the phase markers echoed by the container bootstrap from the yarn logs. Returns
+# the phases with their start and end as epoch seconds in the order they started.
+def parse_phase_markers(yarn_logs_output):
+    markers = {}
+    for match in re.finditer(
+        r"^\S+: (.+) (start|end):? (\d{4}-\d\d-\d\d:\d\d:\d\d:\d\d)(\.\d+)?([+-]\d{4})?$",
+        yarn_logs_output,
+        re.M,
+    ):
+        phase, edge, timestamp, fraction, timezone = match.groups()
+        timestamp = datetime.strptime(
+            timestamp + (fraction or ".0") + (timezone or ""),
+            "%Y-%m-%d:%H:%M:%S.%f" + ("%z" if timezone else ""),
+        )
+        markers.setdefault(phase, {})[edge] = timestamp.timestamp()
 
+    return [
+        (phase, marker["start"], marker["end"])
+        for phase, marker in markers.items()
+        if "start" in marker and "end" in marker
+    ]
 
-# generate JSON payload dynamically to send to yarn container to generate /serve dbt docs
-def generate_yarn_payload():
-    kerberos_principal = {}
-    service_user_keytab = get_service_user_keytab()
-    kerberos_principal["keytab"] = "file://{}".format(service_user_keytab)
-    host = socket.gethostname()
-    principal = "{}/{}"
-    kerberos_principal["principal_name"] = "{}/{}".format(
-        ENV_VARIABLES["DBT_SERVICE_USER"], host
+
+# Write a machine readable report with the duration of every phase of a run: packaging
+# and submission on the gateway, queue wait and container allocation in yarn, and the
+# bootstrap phases inside the container. The report is written as json, and optionally
+# as a prometheus textfile for the node exporter.
+def write_timing_report(app_name, yarn_id, submission_start, gateway_phases, logs):
+    report_dir = ENV_VARIABLES["YARN_TIMING_REPORT_DIR"]
+    prometheus_file = ENV_VARIABLES["YARN_TIMING_PROMETHEUS_FILE"]
+    if not report_dir and not prometheus_file:
+        return
+
+    phases = [("gateway", phase, start, end) for phase, start, end in gateway_phases]
+    container_phases = parse_phase_markers(logs)
+
+    try:
+        app_report = get_yarn_app_report(yarn_id)
+    except requests.RequestException as e:
+        logging.warning("Couldn't fetch application report of %s: %s", yarn_id, e)
+        app_report = {}
+
+    # ResourceManager times are epoch milliseconds
+    started = app_report.get("startedTime", 0) / 1000
+    launched = app_report.get("launchTime", 0) / 1000
+    finished = app_report.get("finishedTime", 0) / 1000
+    if started:
+        phases.append(("gateway", "Submit application", submission_start, started))
+    if started and launched:
+        phases.append(("yarn", "Queue wait", started, launched))
+        if container_phases:
+            phases.append(
+                ("yarn", "Container allocation", launched, container_phases[0][1])
+            )
+    if started and finished:
+        phases.append(("yarn", "Application", started, finished))
+    phases.extend(
+        ("container", phase, start, end) for phase, start, end in container_phases
+    )
+
+    report = {
+        "app_name": app_name,
+        "application_id": yarn_id,
+        "project": ENV_VARIABLES["DBT_PROJECT_NAME"],
+        "command": sys.argv[1],
+        "final_status": app_report.get("finalStatus"),
+        "phases": [
+            {
+                "source": source,
+                "phase": phase,
+                "start": datetime.fromtimestamp(start).isoformat(
+                    timespec="milliseconds"
+                ),
+                "end": datetime.fromtimestamp(end).isoformat(timespec="milliseconds"),
+                "duration_seconds": round(end - start, 3),
+            }
+            for source, phase, start, end in phases
+        ],
+    }
+
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+        report_path = os.path.join(report_dir, "{}.json".format(app_name))
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Timing report written to {}".format(report_path))
+        cleanup_timing_reports(report_dir)
+
+    if prometheus_file:
+        labels = 'project="{}",command="{}"'.format(
+            prometheus_label_value(report["project"]),
+            prometheus_label_value(report["command"]),
+        )
+        lines = [
+            "# HELP yarn_dbt_phase_duration_seconds Duration of the phases of the last yarn_dbt run.",
+            "# TYPE yarn_dbt_phase_duration_seconds gauge",
+        ]
+        for phase in report["phases"]:
+            lines.append(
+                'yarn_dbt_phase_duration_seconds{{{},source="{}",phase="{}"}} {}'.format(
+                    labels,
+                    phase["source"],
+                    prometheus_label_value(phase["phase"]),
+                    phase["duration_seconds"],
+                )
+            )
+        lines.append(
+            "yarn_dbt_last_run_timestamp_seconds{{{}}} {}".format(labels, time.time())
+        )
+
+        # the node exporter must never read a partially written file
+        with open(prometheus_file + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(prometheus_file + ".tmp", prometheus_file)
+
+
+# Delete the timing reports older than YARN_TIMING_REPORT_RETENTION_DAYS.
+def cleanup_timing_reports(report_dir):
+    expiry = (
+        time.time()
+        - float(ENV_VARIABLES["YARN_TIMING_REPORT_RETENTION_DAYS"]) * 24 * 3600
+    )
+    for name in fnmatch.filter(os.listdir(report_dir), "*.json"):
+        report_path = os.path.join(report_dir, name)
+        try:
+            if os.path.getmtime(report_path) < expiry:
+                os.remove(report_path)
+        except OSError:
+            # removed by a concurrent run
+            continue
+
+
+def prometheus_label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Key of a dbt invocation in the sizing history: the project, the dbt command and the
+# node selection.
+def get_history_key(dbt_args):
+    selectors = []
+    for index, arg in enumerate(dbt_args[:-1]):
+        if arg in ["--select", "-s", "--models", "-m", "--exclude", "--selector"]:
+            selectors.append("{} {}".format(arg, dbt_args[index + 1]))
+    return "{}|{}|{}".format(
+        ENV_VARIABLES["DBT_PROJECT_NAME"], dbt_args[0], " ".join(selectors)
     )
-    copy_project_to_hdfs()
 
-    component = {}
-    component["name"] = "dbtdocs"
-    component["number_of_containers"] = 1
 
-    yarn_local_working_dir = "/tmp/dbt-{}".format(
-        datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")
+def load_run_history():
+    history_path = os.path.join(YARN_DBT_STATE_DIR, "history.json")
+    if not os.path.isfile(history_path):
+        return {}
+    with open(history_path) as f:
+        return json.load(f)
+
+
+# Record the resource usage of a finished run in the local sizing history: the peak
+# memory and cpu usage of dbt reported by the container, and the vcore seconds and
+# duration from the application report. Only the last YARN_SIZING_HISTORY_RUNS runs of
+# every invocation are kept.
+def record_run_history(yarn_id, dbt_args, logs):
+    match = re.search(
+        r"^yarn_dbt resource usage: (\d+) ([\d.]+) ([\d.]+)$", logs or "", re.M
     )
+    if match is None:
+        logging.info("No resource usage reported by %s", yarn_id)
+        return
 
-    create_working_dir_command = (
-        "mkdir -p {} && cd {} && python3 -m venv {}/dbt-venv".format(
-            yarn_local_working_dir,
-            yarn_local_working_dir,
-            yarn_local_working_dir,
-            yarn_local_working_dir,
+    try:
+        app_report = get_yarn_app_report(yarn_id)
+    except requests.RequestException as e:
+        logging.warning("Couldn't fetch application report of %s: %s", yarn_id, e)
+        app_report = {}
+
+    peak_memory_kb, cpu_seconds, wall_seconds = match.groups()
+    run = {
+        "application_id": yarn_id,
+        "finished": datetime.utcnow().isoformat(timespec="seconds"),
+        "final_status": app_report.get("finalStatus"),
+        "peak_memory_mb": math.ceil(int(peak_memory_kb) / 1024),
+        "cpu_seconds": round(float(cpu_seconds), 3),
+        "dbt_seconds": round(float(wall_seconds), 3),
+        "duration_seconds": app_report.get("elapsedTime", 0) / 1000,
+        "vcore_seconds": app_report.get("vcoreSeconds"),
+        "memory_mb_seconds": app_report.get("memorySeconds"),
+    }
+
+    # concurrent yarn_dbt processes of the user update the history one at a time
+    locks_dir = os.path.join(YARN_DBT_STATE_DIR, "locks")
+    os.makedirs(locks_dir, exist_ok=True)
+    with open(os.path.join(locks_dir, "history.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        history = load_run_history()
+        runs = history.setdefault(get_history_key(dbt_args), [])
+        runs.append(run)
+        del runs[: -int(ENV_VARIABLES["YARN_SIZING_HISTORY_RUNS"])]
+
+        history_path = os.path.join(YARN_DBT_STATE_DIR, "history.json")
+        with open(history_path + ".tmp", "w") as f:
+            json.dump(history, f, indent=2)
+        os.replace(history_path + ".tmp", history_path)
+
+
+# Nearest rank percentile of a list of numbers.
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+# Return the container memory in MB and vcores for a dbt invocation. Once enough runs of
+# the same invocation are in the sizing history, the size is derived from the
+# YARN_SIZING_PERCENTILE percentile of their peak memory and average cpu usage plus
+# YARN_SIZING_HEADROOM_PERCENT. Only dbt itself is measured, the memory of the hdfs
+# clients and pip that run next to it in the container is covered by
+# YARN_SIZING_OVERHEAD_MB, and the memory is never less than YARN_SIZING_MIN_MEMORY.
+# Depending on YARN_SIZING_MODE the size is only suggested or used instead of
+# YARN_CONTAINER_MEMORY and YARN_CONTAINER_VCORES.
+def get_container_size(dbt_args=None):
+    container_memory = ENV_VARIABLES["YARN_CONTAINER_MEMORY"]
+    container_vcores = ENV_VARIABLES["YARN_CONTAINER_VCORES"]
+    if ENV_VARIABLES["YARN_SIZING_MODE"] == "off":
+        return container_memory, container_vcores
+
+    if dbt_args is None:
+        dbt_args = sys.argv[1:]
+    runs = load_run_history().get(get_history_key(dbt_args), [])
+    if len(runs) < int(ENV_VARIABLES["YARN_SIZING_MIN_RUNS"]):
+        return container_memory, container_vcores
+
+    percent = float(ENV_VARIABLES["YARN_SIZING_PERCENTILE"])
+    headroom = 1 + float(ENV_VARIABLES["YARN_SIZING_HEADROOM_PERCENT"]) / 100
+    peak_memory = percentile([run["peak_memory_mb"] for run in runs], percent)
+    cpu_usage = percentile(
+        [run["cpu_seconds"] / max(run["dbt_seconds"], 1) for run in runs], percent
+    )
+    # yarn rounds container memory up to multiples of its minimum allocation
+    suggested_memory = max(
+        math.ceil(
+            (peak_memory * headroom + int(ENV_VARIABLES["YARN_SIZING_OVERHEAD_MB"]))
+            / 512
+        )
+        * 512,
+        int(ENV_VARIABLES["YARN_SIZING_MIN_MEMORY"]),
+    )
+    suggested_memory = str(suggested_memory)
+    suggested_vcores = str(max(math.ceil(cpu_usage * headroom), 1))
+
+    if ENV_VARIABLES["YARN_SIZING_MODE"] == "apply":
+        logging.info(
+            "Sizing container from %s runs: %s MB memory, %s vcores",
+            len(runs),
+            suggested_memory,
+            suggested_vcores,
+        )
+        return suggested_memory, suggested_vcores
+
+    if (suggested_memory, suggested_vcores) != (container_memory, container_vcores):
+        print(
+            "Suggested container size from {} previous runs: YARN_CONTAINER_MEMORY={} YARN_CONTAINER_VCORES={}".format(
+                len(runs), suggested_memory, suggested_vcores
+            )
+        )
+    return container_memory, container_vcores
+
+
+# Collect the files of the dbt project that are shipped to yarn containers, skipping
+# the paths relative to the project directory that match the ignore list.
+def list_project_files(project_dir, ignore_patterns):
+    project_files = []
+    for dirpath, dirnames, filenames in os.walk(project_dir):
+        relative_dir = os.path.relpath(dirpath, project_dir)
+
+        # prune ignored directories so that their content is never read
+        dirnames[:] = sorted(
+            dirname
+            for dirname in dirnames
+            if not any(
+                fnmatch.fnmatch(
+                    os.path.normpath(os.path.join(relative_dir, dirname)), pattern
+                )
+                for pattern in ignore_patterns
+            )
         )
+        for filename in sorted(filenames):
+            relative_path = os.path.normpath(os.path.join(relative_dir, filename))
+            if not any(
+                fnmatch.fnmatch(relative_path, pattern) for pattern in ignore_patterns
+            ):
+                project_files.append(relative_path)
+    return project_files
+
+
+# sha256 of a project file, symbolic links are hashed by their target.
+def hash_project_file(path):
+    digest = hashlib.sha256()
+    if os.path.islink(path):
+        digest.update(os.readlink(path).encode())
+        return digest.hexdigest()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Path of the compressed dbt project on the gateway, named after the configured codec.
+def get_compressed_project_directory():
+    return os.path.join(
+        PROJECT_ARCHIVE_DIR,
+        "dbt-workspace.{}".format(
+            PROJECT_ARCHIVE_EXTENSIONS[ENV_VARIABLES["DBT_PROJECT_CODEC"]]
+        ),
+    )
+
+
+# Open a writable stream that compresses into the given file with the configured codec.
+# zstd compresses with one worker thread per cpu core.
+def open_compressed_stream(f):
+    codec = ENV_VARIABLES["DBT_PROJECT_CODEC"]
+    if codec == "zstd":
+        if zstandard is None:
+            logging.critical("DBT_PROJECT_CODEC zstd requires: pip install zstandard")
+            sys.exit(10)
+        return zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(f)
+    elif codec == "lz4":
+        if lz4 is None:
+            logging.critical("DBT_PROJECT_CODEC lz4 requires: pip install lz4")
+            sys.exit(10)
+        return lz4.frame.open(f, mode="wb")
+    return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6)
+
+
+# Generate the shell command that extracts a compressed tar archive inside a yarn
+# container. The codec is detected from the magic number of the archive.
+def generate_extract_command(archive, directory):
+    return "case $(od -An -tx1 -N4 {0} | tr -d ' ') in 28b52ffd) zstd -dcq {0} ;; 04224d18) lz4 -dcq {0} ;; *) gzip -dc {0} ;; esac | tar -xf - --directory {1}".format(
+        archive,
+        directory,
     )
 
-    download_python_dependencies_from_hdfs = (
-        "hdfs dfs -copyToLocal {}/{} {} && tar -zxf {}/{} --directory {}".format(
+
+# Compress current dbt project to localize in yarn containers. A manifest with the
+# content hash of every project file is kept next to the archive; files whose size and
+# modification time didn't change since the previous run are not hashed again and the
+# previous archive is reused when no file changed.
+def compress_project_directory():
+    logging.info(
+        "Compressing dbt project directory: %s/%s",
+        os.getcwd(),
+        ENV_VARIABLES["DBT_PROJECT_NAME"],
+    )
+    compressed_project_directory = get_compressed_project_directory()
+    manifest_path = compressed_project_directory + ".manifest.json"
+    project_dir = ENV_VARIABLES["DBT_PROJECT_NAME"]
+    ignore_patterns = [
+        pattern.strip()
+        for pattern in ENV_VARIABLES["DBT_PROJECT_IGNORE"].split(",")
+        if pattern.strip()
+    ]
+
+    previous_manifest = {}
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                previous_manifest = json.load(f)
+        except ValueError:
+            logging.warning("Ignoring corrupt project manifest %s", manifest_path)
+    previous_files = previous_manifest.get("files", {})
+
+    manifest = {"project": os.path.abspath(project_dir), "files": {}}
+    for relative_path in list_project_files(project_dir, ignore_patterns):
+        path = os.path.join(project_dir, relative_path)
+        stat = os.lstat(path)
+        previous_entry = previous_files.get(relative_path)
+        if previous_entry and previous_entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            file_hash = previous_entry[2]
+        else:
+            file_hash = hash_project_file(path)
+        manifest["files"][relative_path] = [stat.st_size, stat.st_mtime_ns, file_hash]
+
+    unchanged = (
+        os.path.isfile(compressed_project_directory)
+        and previous_manifest.get("project") == manifest["project"]
+        and {k: v[2] for k, v in previous_files.items()}
+        == {k: v[2] for k, v in manifest["files"].items()}
+    )
+
+    if unchanged:
+        logging.info("dbt project unchanged, reusing %s", compressed_project_directory)
+    else:
+        # write to a temporary file so that an interrupted run never leaves a partial
+        # archive behind that matches the manifest
+        temporary_archive = compressed_project_directory + ".tmp"
+        with open(temporary_archive, "wb") as f:
+            with open_compressed_stream(f) as stream:
+                # stream the tar directly into the compressor without an intermediate
+                # uncompressed archive
+                with tarfile.open(fileobj=stream, mode="w|") as archive:
+                    for relative_path in manifest["files"]:
+                        archive.add(
+                            os.path.join(project_dir, relative_path),
+                            arcname=os.path.join(
+                                os.path.normpath(project_dir), relative_path
+                            ),
+                            recursive=False,
+                        )
+        os.replace(temporary_archive, compressed_project_directory)
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    logging.info("Done compressing dbt project directory.")
+
+
+# Unique name of a yarn_dbt run. Runs that the same user starts within the same second
+# get different names, which also keep their files apart on the gateway, in hdfs and in
+# the yarn containers.
+def generate_run_name(kind=None):
+    return ".".join(
+        ["dbt", ENV_VARIABLES["CURRENT_DBT_USER"]]
+        + ([kind] if kind else [])
+        + [
+            "{}-{}".format(
+                datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S"), uuid.uuid4().hex[:6]
+            )
+        ]
+    )
+
+
+# Package the dbt project for a run and return the path of the archive of the run. The
+# shared archive is rewritten by one process at a time, and by at most
+# YARN_PACKAGING_CONCURRENCY processes of the user over all projects. Every run gets a
+# hard link to the archive it packaged, so that concurrent runs never ship each other's
+# archive.
+def package_project_for_run(run_name):
+    runs_dir = os.path.join(YARN_DBT_STATE_DIR, "runs")
+    cleanup_run_files(runs_dir)
+    run_dir = os.path.join(runs_dir, run_name)
+    os.makedirs(run_dir, exist_ok=True)
+
+    compressed_project_directory = get_compressed_project_directory()
+    run_archive = os.path.join(run_dir, os.path.basename(compressed_project_directory))
+    slot = acquire_packaging_slot()
+    try:
+        with open(compressed_project_directory + ".lock", "w") as archive_lock:
+            fcntl.flock(archive_lock, fcntl.LOCK_EX)
+            compress_project_directory()
+            try:
+                os.link(compressed_project_directory, run_archive)
+            except OSError:
+                # hard links only work within a file system
+                shutil.copyfile(compressed_project_directory, run_archive)
+    finally:
+        slot.close()
+    return run_archive
+
+
+# Take one of the YARN_PACKAGING_CONCURRENCY packaging slots shared by the yarn_dbt
+# processes of the user on the gateway, waiting while all of them are taken. The slot is
+# released when the returned file is closed or the process exits.
+def acquire_packaging_slot():
+    locks_dir = os.path.join(YARN_DBT_STATE_DIR, "locks")
+    os.makedirs(locks_dir, exist_ok=True)
+    waiting = False
+    while True:
+        for index in range(int(ENV_VARIABLES["YARN_PACKAGING_CONCURRENCY"])):
+            slot = open(os.path.join(locks_dir, "packaging.{}.lock".format(index)), "w")
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                slot.close()
+        if not waiting:
+            logging.info("Waiting for a packaging slot.")
+            waiting = True
+        time.sleep(0.2)
+
+
+# Remove the files of a run on the gateway once yarn copied them.
+def release_run_files(run_name):
+    shutil.rmtree(
+        os.path.join(YARN_DBT_STATE_DIR, "runs", run_name), ignore_errors=True
+    )
+
+
+# Remove the files that runs which didn't finish left behind for longer than
+# YARN_RUN_FILES_RETENTION_HOURS.
+def cleanup_run_files(runs_dir):
+    if not os.path.isdir(runs_dir):
+        return
+    expiry = time.time() - float(ENV_VARIABLES["YARN_RUN_FILES_RETENTION_HOURS"]) * 3600
+    for name in os.listdir(runs_dir):
+        run_dir = os.path.join(runs_dir, name)
+        try:
+            if os.path.getmtime(run_dir) < expiry:
+                shutil.rmtree(run_dir, ignore_errors=True)
+                logging.info("Deleted files of unfinished run %s", name)
+        except OSError:
+            # removed by a concurrent run
+            continue
+
+
+# Package the dbt project and generate the distributed shell client command that runs
+# the current dbt command in a yarn container.
+def generate_distributed_shell_command(
+    app_name, dbt_args=None, artifacts=(), gateway_phases=None, slim=False
+):
+    packaging_start = time.time()
+
+    logging.debug(
+        "%s",
+        "{}: Compress dbt project directory start: {}".format(
+            app_name, datetime.utcnow().strftime("%Y-%m-%d:%H-%M-%S")
+        ),
+    )
+
+    run_archive = package_project_for_run(app_name)
+    if gateway_phases is not None:
+        gateway_phases.append(("Package dbt project", packaging_start, time.time()))
+
+    logging.debug(
+        "%s",
+        "{}: Compress dbt project directory end: {}".format(
+            app_name, datetime.utcnow().strftime("%Y-%m-%d:%H-%M-%S")
+        ),
+    )
+
+    # the containers publish to hdfs directories that are shared by all users
+    if dbt_args is None:
+        dbt_args = sys.argv[1:]
+    shared_dirs = [ENV_VARIABLES["DBT_ARTIFACTS_PATH_HDFS"]]
+    if ENV_VARIABLES["DBT_PARTIAL_PARSE_CACHE_ENABLED"].lower() == "true":
+        shared_dirs.append(ENV_VARIABLES["DBT_PARTIAL_PARSE_PATH_HDFS"])
+    if dbt_args[0] == "run" and not has_node_selection(dbt_args):
+        shared_dirs.append(ENV_VARIABLES["DBT_STATE_PATH_HDFS"])
+    ensure_shared_hdfs_dirs(shared_dirs)
+
+    shell_command = generate_yarn_shell_command(app_name, dbt_args, artifacts, slim)
+    logging.info("shell command generated: %s", shell_command)
+    container_memory, container_vcores = get_container_size(dbt_args)
+
+    localize_files = [run_archive, DBT_LOG_INDEXER]
+    if ENV_VARIABLES["YARN_SHIP_TICKET_CACHE"].lower() == "true":
+        localize_files.append(
+            get_credential_cache(ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"])
+        )
+
+    return [
+        "hadoop",
+        "org.apache.hadoop.yarn.applications.distributedshell.Client",
+        "-jar",
+        ENV_VARIABLES["YARN_JAR"],
+        "-container_memory",
+        container_memory,
+        "-container_vcores",
+        container_vcores,
+        "-localize_files",
+        ",".join(localize_files),
+        "-timeout",
+        ENV_VARIABLES["YARN_TIMEOUT"],
+        "-appname",
+        app_name,
+        "-application_tags",
+        ENV_VARIABLES["APPLICATION_TAGS"],
+        "-shell_command",
+        shell_command,
+    ]
+
+
+def launch_yarn_container_with_dbt_command(follow=False, slim=False, dbt_args=None):
+    app_name = generate_run_name()
+    gateway_phases = []
+    if dbt_args is None:
+        dbt_args = sys.argv[1:]
+    client_command = generate_distributed_shell_command(
+        app_name, dbt_args, gateway_phases=gateway_phases, slim=slim
+    )
+    logging.info(
+        "Starting to execute the DBT job in YARN using Distributed Shell App for appid: %s",
+        app_name,
+    )
+
+    # allow for clock skew between the gateway and the ResourceManager
+    submission_start = time.time()
+    started_time_begin = int(submission_start * 1000) - 60000
+
+    # the run files are released also when the client failed before the submission
+    try:
+        if follow:
+            # Stream to console the output from dbt while it runs
+            yarn_id, yarn_logs, returncode, client_output = follow_yarn_logs(
+                client_command, app_name, started_time_begin, "prelaunch.out"
+            )
+        else:
+            try:
+                result = subprocess.run(
+                    client_command,
+                    capture_output=True,
+                    text=True,
+                )
+            except Exception as e:
+                logging.critical("There was an error completing dbt command.")
+                print(e)
+                sys.exit(10)
+            returncode = result.returncode
+            client_output = result.stdout + result.stderr
+
+            # Print to console the output from dbt, also when the dbt command failed
+            yarn_id = get_yarn_app_id(
+                app_name, client_output, started_time_begin, returncode
+            )
+            yarn_logs = print_yarn_logs(yarn_id, "prelaunch.out")
+    finally:
+        release_run_files(app_name)
+    yarn_log_string = "yarn logs -applicationId {}".format(yarn_id)
+    print("To display all yarn container logs run command: ")
+    print(yarn_log_string, "\n")
+
+    write_timing_report(app_name, yarn_id, submission_start, gateway_phases, yarn_logs)
+    record_run_history(yarn_id, dbt_args, yarn_logs)
+
+    if returncode != 0:
+        logging.critical("There was an error completing dbt command.")
+        print(client_output)
+        sys.exit(10)
+
+
+# Submit the dbt command to yarn and return as soon as the ResourceManager accepted the
+# application. The distributed shell client is stopped once it reported the application
+# id, the application keeps running in yarn without it.
+def submit_yarn_container_with_dbt_command(
+    app_name=None, dbt_args=None, artifacts=(), slim=False
+):
+    if app_name is None:
+        app_name = generate_run_name()
+    client_command = generate_distributed_shell_command(
+        app_name, dbt_args, artifacts, slim=slim
+    )
+
+    submission_start = time.time()
+    client = subprocess.Popen(
+        client_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    client_output = []
+    yarn_id = None
+    for line in client.stdout:
+        client_output.append(line)
+        match = re.search(r"application_\d+_\d+", line)
+        if match:
+            yarn_id = match.group(0)
+            break
+
+    if client.poll() is None:
+        client.terminate()
+    client.wait()
+    # the client uploaded the localized files before it submitted the application
+    release_run_files(app_name)
+
+    if yarn_id is None:
+        logging.critical("There was an error submitting dbt command.")
+        print("".join(client_output))
+        sys.exit(10)
+
+    # the client enforced the timeout of the distributed shell, let yarn enforce it now
+    set_yarn_app_lifetime(
+        yarn_id, submission_start + int(ENV_VARIABLES["YARN_TIMEOUT"]) / 1000
+    )
+
+    logging.info("Submitted %s as yarn application %s", app_name, yarn_id)
+    print(yarn_id)
+    return yarn_id
+
+
+# Set the lifetime of a yarn application so that the ResourceManager kills it once the
+# given unix time has passed.
+def set_yarn_app_lifetime(yarn_id, expiry_time):
+    expiry = datetime.fromtimestamp(expiry_time).astimezone()
+    # Rest Api doc: https://hadoop.apache.org/docs/stable/hadoop-yarn/hadoop-yarn-site/ResourceManagerRest.html#Cluster_Application_Timeout_API
+    try:
+        response = get_yarn_session().put(
+            "{}/ws/v1/cluster/apps/{}/timeout".format(
+                ENV_VARIABLES["YARN_RM_URI"], yarn_id
+            ),
+            data=json.dumps(
+                {
+                    "timeout": {
+                        "type": "LIFETIME",
+                        "expiryTime": expiry.strftime("%Y-%m-%dT%H:%M:%S.")
+                        + "{:03d}".format(expiry.microsecond // 1000)
+                        + expiry.strftime("%z"),
+                    }
+                }
+            ),
+            headers={"Content-Type": "application/json"},
+            timeout=30,
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logging.warning(
+            "Couldn't set the lifetime of yarn application %s: %s", yarn_id, e
+        )
+
+
+# Fetch the application report of a yarn application from the ResourceManager.
+def get_yarn_app_report(yarn_id):
+    # Rest Api doc: https://hadoop.apache.org/docs/stable/hadoop-yarn/hadoop-yarn-site/ResourceManagerRest.html#Cluster_Application_API
+    response = get_yarn_session().get(
+        "{}/ws/v1/cluster/apps/{}".format(ENV_VARIABLES["YARN_RM_URI"], yarn_id),
+        timeout=30,
+    )
+    response.raise_for_status()
+    return response.json()["app"]
+
+
+# Print a one line json status for each of the given yarn applications.
+def print_yarn_app_status(yarn_ids):
+    for yarn_id in yarn_ids:
+        app_report = get_yarn_app_report(yarn_id)
+        print(
+            json.dumps(
+                {
+                    "id": app_report["id"],
+                    "name": app_report["name"],
+                    "state": app_report["state"],
+                    "finalStatus": app_report["finalStatus"],
+                    "progress": app_report["progress"],
+                    "elapsedTime": app_report["elapsedTime"],
+                    "trackingUrl": app_report.get("trackingUrl"),
+                }
+            )
+        )
+
+
+# Poll the ResourceManager until all of the given yarn applications are done and return
+# their final status.
+def poll_yarn_apps(yarn_ids):
+    pending = list(yarn_ids)
+    final_status = {}
+    while pending:
+        for yarn_id in list(pending):
+            app_report = get_yarn_app_report(yarn_id)
+            if app_report["state"] in ["FINISHED", "FAILED", "KILLED"]:
+                final_status[yarn_id] = app_report["finalStatus"]
+                pending.remove(yarn_id)
+        if pending:
+            time.sleep(int(ENV_VARIABLES["YARN_POLL_INTERVAL"]))
+    return final_status
+
+
+# Wait until all of the given yarn applications are done, then print the dbt output of
+# each. Exits with an error if any application didn't succeed.
+def wait_for_yarn_apps(yarn_ids):
+    final_status = poll_yarn_apps(yarn_ids)
+
+    for yarn_id in yarn_ids:
+        # the logs may not be aggregated yet, the status is printed regardless
+        try:
+            print_yarn_logs(yarn_id, "prelaunch.out")
+        except subprocess.CalledProcessError as e:
+            logging.warning("Couldn't print the logs of %s: %s", yarn_id, e.stderr)
+        print("{}: {}".format(yarn_id, final_status[yarn_id]))
+
+    failed = [yarn_id for yarn_id in yarn_ids if final_status[yarn_id] != "SUCCEEDED"]
+    if failed:
+        logging.critical("Yarn applications didn't succeed: %s", failed)
+        sys.exit(10)
+
+
+# Kill the given yarn applications through the ResourceManager.
+def kill_yarn_apps(yarn_ids):
+    for yarn_id in yarn_ids:
+        response = get_yarn_session().put(
+            "{}/ws/v1/cluster/apps/{}/state".format(
+                ENV_VARIABLES["YARN_RM_URI"], yarn_id
+            ),
+            data=json.dumps({"state": "KILLED"}),
+            headers={"Content-Type": "application/json"},
+            timeout=30,
+        )
+        response.raise_for_status()
+        print("{}: {}".format(yarn_id, response.json()["state"]))
+
+
+# Split the models of a dbt manifest into shards that run in separate yarn containers.
+# Independent subgraphs of the model DAG are packed into the shards when there are at
+# least as many of them as shards. Otherwise the DAG is cut into topological waves whose
+# models are spread over the shards. Returns the list of waves, each a list of shards
+# with the node selectors of their models. Waves run one after the other, the shards of
+# a wave run concurrently.
+def plan_dbt_shards(manifest, shard_count):
+    models = {
+        unique_id: node
+        for unique_id, node in manifest["nodes"].items()
+        if node["resource_type"] == "model"
+    }
+    parents = {
+        unique_id: [
+            parent for parent in node["depends_on"]["nodes"] if parent in models
+        ]
+        for unique_id, node in models.items()
+    }
+
+    # union find over the undirected model graph
+    roots = {unique_id: unique_id for unique_id in models}
+
+    def find_root(unique_id):
+        while roots[unique_id] != unique_id:
+            roots[unique_id] = roots[roots[unique_id]]
+            unique_id = roots[unique_id]
+        return unique_id
+
+    for unique_id, model_parents in parents.items():
+        for parent in model_parents:
+            roots[find_root(parent)] = find_root(unique_id)
+
+    components = {}
+    for unique_id in sorted(models):
+        components.setdefault(find_root(unique_id), []).append(unique_id)
+
+    if len(components) >= shard_count:
+        # largest subgraphs first into the currently smallest shard
+        shards = [[] for _ in range(shard_count)]
+        for component in sorted(components.values(), key=len, reverse=True):
+            min(shards, key=len).extend(component)
+        waves = [shards]
+    else:
+        # a model runs in the wave after the last of its parents
+        children = {unique_id: [] for unique_id in models}
+        in_degree = {unique_id: len(parents[unique_id]) for unique_id in models}
+        for unique_id, model_parents in parents.items():
+            for parent in model_parents:
+                children[parent].append(unique_id)
+
+        waves = []
+        ready = sorted(
+            unique_id for unique_id, degree in in_degree.items() if degree == 0
+        )
+        while ready:
+            waves.append([ready[index::shard_count] for index in range(shard_count)])
+            next_ready = []
+            for unique_id in ready:
+                for child in children[unique_id]:
+                    in_degree[child] -= 1
+                    if in_degree[child] == 0:
+                        next_ready.append(child)
+            ready = sorted(next_ready)
+
+    selectors = get_node_selectors(manifest)
+    return [
+        [sorted(selectors[unique_id] for unique_id in shard) for shard in wave if shard]
+        for wave in waves
+    ]
+
+
+# Return a node selector for every node of a dbt manifest that selects only that node.
+# The fqn method matches by prefix, so the fqn of models/staging.sql also selects the
+# models in models/staging/. Nodes of the root project that are the only node defined
+# in their file are selected by the path of the file instead. The path method resolves
+# paths in the root project, other nodes keep the fqn.
+def get_node_selectors(manifest):
+    root_project = manifest.get("metadata", {}).get("project_name")
+    file_nodes = {}
+    for node in manifest["nodes"].values():
+        key = (node["package_name"], node["original_file_path"])
+        file_nodes[key] = file_nodes.get(key, 0) + 1
+
+    selectors = {}
+    for unique_id, node in manifest["nodes"].items():
+        if (
+            node["package_name"] == root_project
+            and file_nodes[(node["package_name"], node["original_file_path"])] == 1
+        ):
+            selectors[unique_id] = "path:" + node["original_file_path"]
+        else:
+            selectors[unique_id] = "fqn:" + ".".join(node["fqn"])
+    return selectors
+
+
+# Merge the run_results.json published by the shard containers into one document.
+def merge_run_results(run_results_documents):
+    merged = dict(run_results_documents[0])
+    merged["results"] = [
+        result for document in run_results_documents for result in document["results"]
+    ]
+    merged["elapsed_time"] = sum(
+        document["elapsed_time"] for document in run_results_documents
+    )
+    return merged
+
+
+# Run the dbt command sharded over several yarn containers using the model DAG from
+# target/manifest.json and write the combined run_results.json to the project target
+# directory.
+def run_dbt_shards(shard_count):
+    # every shard gets its own selection of models
+    if has_node_selection(sys.argv[1:]):
+        logging.critical("Option --shards can't be combined with node selection.")
+        sys.exit(10)
+
+    manifest_path = os.path.join(
+        ENV_VARIABLES["DBT_PROJECT_NAME"], "target", "manifest.json"
+    )
+    if not os.path.isfile(manifest_path):
+        logging.critical(
+            "Missing %s, run dbt parse before running sharded.", manifest_path
+        )
+        sys.exit(10)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    waves = plan_dbt_shards(manifest, shard_count)
+    logging.info(
+        "Running %s waves of shards: %s", len(waves), [len(wave) for wave in waves]
+    )
+
+    run_name = generate_run_name()
+    shard_apps = []
+    failed = False
+    for wave_index, wave in enumerate(waves):
+        yarn_ids = []
+        for shard_index, selectors in enumerate(wave):
+            app_name = "{}.w{}s{}".format(run_name, wave_index, shard_index)
+            yarn_id = submit_yarn_container_with_dbt_command(
+                app_name,
+                sys.argv[1:] + ["--select"] + selectors,
+                ["run_results.json"],
+            )
+            yarn_ids.append(yarn_id)
+            shard_apps.append([wave_index, shard_index, app_name, yarn_id, selectors])
+
+        final_status = poll_yarn_apps(yarn_ids)
+        for shard_app in shard_apps[-len(yarn_ids) :]:
+            shard_app.append(final_status[shard_app[3]])
+        if any(final_status[yarn_id] != "SUCCEEDED" for yarn_id in yarn_ids):
+            # later waves depend on the models of this one
+            failed = True
+            break
+
+    # the run results of all shards in a single hdfs call
+    result = subprocess.run(
+        ["hdfs", "dfs", "-cat"]
+        + [
+            "{}/{}/run_results.json".format(
+                ENV_VARIABLES["DBT_ARTIFACTS_PATH_HDFS"], shard_app[2]
+            )
+            for shard_app in shard_apps
+        ],
+        capture_output=True,
+        text=True,
+    )
+    decoder = json.JSONDecoder()
+    run_results_documents = []
+    position = 0
+    output = result.stdout.strip()
+    while position < len(output):
+        document, position = decoder.raw_decode(output, position)
+        run_results_documents.append(document)
+        while position < len(output) and output[position].isspace():
+            position += 1
+
+    if run_results_documents:
+        run_results_path = os.path.join(
+            ENV_VARIABLES["DBT_PROJECT_NAME"], "target", "run_results.json"
+        )
+        with open(run_results_path, "w") as f:
+            json.dump(merge_run_results(run_results_documents), f, indent=2)
+        print("Combined run results written to {}".format(run_results_path))
+
+    print("wave shard application status models")
+    for wave_index, shard_index, app_name, yarn_id, selectors, status in shard_apps:
+        print(
+            "{:>4} {:>5} {} {} {}".format(
+                wave_index, shard_index, yarn_id, status, len(selectors)
+            )
+        )
+
+    if failed:
+        logging.critical("There was an error completing sharded dbt command.")
+        sys.exit(10)
+
+
+# Run the nodes of a failed yarn_dbt run that failed or were skipped again, together
+# with the descendants of the failed nodes in the current project. The run results and
+# the dbt arguments are the ones the failed container preserved in hdfs, the node
+# selection of the original run is replaced.
+def retry_failed_dbt_nodes(yarn_id, follow=False):
+    try:
+        app_report = get_yarn_app_report(yarn_id)
+    except requests.RequestException as e:
+        logging.critical(
+            "There was an error fetching application report of %s.", yarn_id
+        )
+        print(e)
+        sys.exit(10)
+    if app_report["finalStatus"] == "SUCCEEDED":
+        print("{} succeeded, nothing to retry.".format(yarn_id))
+        return
+
+    results_dir = "{}/{}".format(
+        ENV_VARIABLES["DBT_ARTIFACTS_PATH_HDFS"], app_report["name"]
+    )
+    preserved = {}
+    for name in ["yarn_dbt_args.json", "run_results.json", "manifest.json"]:
+        result = subprocess.run(
+            ["hdfs", "dfs", "-cat", "{}/{}".format(results_dir, name)],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            logging.critical(
+                "No run results of %s preserved in %s: %s",
+                yarn_id,
+                results_dir,
+                result.stderr,
+            )
+            sys.exit(10)
+        preserved[name] = json.loads(result.stdout)
+
+    node_selectors = get_node_selectors(preserved["manifest.json"])
+    selectors = set()
+    for node_result in preserved["run_results.json"]["results"]:
+        node_selector = node_selectors.get(node_result["unique_id"])
+        if node_selector is None:
+            continue
+        if node_result["status"] in ["error", "fail", "runtime error"]:
+            selectors.add(node_selector + "+")
+        elif node_result["status"] == "skipped":
+            selectors.add(node_selector)
+    if not selectors:
+        print("{} has no failed or skipped nodes to retry.".format(yarn_id))
+        return
+
+    # drop the node selection of the original run, its values run up to the next option
+    dbt_args = []
+    selecting = False
+    for arg in preserved["yarn_dbt_args.json"]:
+        if arg in ["--select", "-s", "--models", "-m", "--selector"]:
+            selecting = True
+        elif selecting and not arg.startswith("-"):
+            continue
+        else:
+            selecting = False
+            dbt_args.append(arg)
+    dbt_args += ["--select"] + sorted(selectors)
+
+    print(
+        "Retrying {} nodes of {}: {}".format(
+            len(selectors), yarn_id, " ".join(dbt_args)
+        )
+    )
+    launch_yarn_container_with_dbt_command(follow, dbt_args=dbt_args)
+
+
+# Print the dbt log of a yarn_dbt run from the compressed log and the index its
+# container published to hdfs. Only the parts of the log with the lines of the given
+# node and levels are read, through WebHDFS when WEBHDFS_URI is set. Nodes are matched
+# by unique id or by name.
+def print_dbt_logs(yarn_id, node=None, level="info"):
+    try:
+        logs_dir = "{}/{}".format(
+            ENV_VARIABLES["DBT_ARTIFACTS_PATH_HDFS"],
+            get_yarn_app_report(yarn_id)["name"],
+        )
+        index = json.loads(read_hdfs_file("{}/dbt.log.index.json".format(logs_dir)))
+    except (requests.RequestException, subprocess.CalledProcessError) as e:
+        logging.critical("There was an error fetching dbt log index of %s.", yarn_id)
+        print(e)
+        sys.exit(10)
+
+    members = [
+        member
+        for member in index["members"]
+        if DBT_LOG_LEVELS.index(member["level"]) >= DBT_LOG_LEVELS.index(level)
+        and (
+            node is None
+            or member["node"] == node
+            or member["node"].endswith("." + node)
+        )
+    ]
+    log_path = "{}/{}".format(logs_dir, index["log"])
+    if ENV_VARIABLES["WEBHDFS_URI"] or not members:
+        log = None
+    else:
+        # the hdfs command line can't read byte ranges
+        log = read_hdfs_file(log_path)
+
+    lines = []
+    for member in members:
+        if log is None:
+            data = read_hdfs_file(log_path, member["offset"], member["length"])
+        else:
+            data = log[member["offset"] : member["offset"] + member["length"]]
+        for line in gzip.decompress(data).decode(errors="replace").splitlines():
+            try:
+                info = json.loads(line)["info"]
+                lines.append(
+                    (
+                        info.get("ts", ""),
+                        "{} [{}] {}".format(
+                            info.get("ts", ""), info.get("level"), info.get("msg")
+                        ),
+                    )
+                )
+            except (ValueError, KeyError, TypeError):
+                lines.append(("", line))
+
+    # the lines of concurrently running nodes are interleaved again
+    for timestamp, line in sorted(lines, key=lambda line: line[0]):
+        print(line)
+
+    for unique_id, node_summary in index["nodes"].items():
+        if node is not None and (unique_id == node or unique_id.endswith("." + node)):
+            print(json.dumps(dict(node_summary, node=unique_id)))
+
+
+# Read a file from hdfs, or only length bytes from offset on. Byte ranges are read
+# through WebHDFS, the hdfs command line reads whole files.
+def read_hdfs_file(path, offset=0, length=None):
+    if not ENV_VARIABLES["WEBHDFS_URI"]:
+        return subprocess.run(
+            ["hdfs", "dfs", "-cat", path], check=True, capture_output=True
+        ).stdout
+
+    params = {"offset": offset}
+    if length is not None:
+        params["length"] = length
+    response = webhdfs_request("GET", path, "OPEN", **params)
+    if response.is_redirect:
+        # the NameNode redirects the read to a DataNode
+        response = get_yarn_session().get(response.headers["Location"], timeout=300)
+        response.raise_for_status()
+    return response.content
+
+
+# Run the dbt commands of many projects from one yarn_dbt process. The batch spec is a
+# json document:
+#   {"parallelism": 4,
+#    "projects": [{"name": "sales", "project_dir": "/path/to/sales", "args": ["run"]}]}
+# The configuration, the kerberos ticket and the python dependencies artifact are looked
+# up once. Projects are packaged and submitted by a pool of parallelism processes, the
+# commands of the same project directory one after the other so that they share the
+# archive. All applications are then monitored together and a table with the result of
+# every command is printed. Exits with an error if any command didn't succeed.
+def run_dbt_batch(spec_path):
+    try:
+        with open(spec_path) as f:
+            spec = json.load(f)
+        entries = spec["projects"]
+        for entry in entries:
+            entry["project_dir"] = os.path.abspath(entry["project_dir"])
+            entry.setdefault("name", os.path.basename(entry["project_dir"]))
+            if not entry["args"] or entry["args"][0] not in commands:
+                raise ValueError(
+                    "unsupported dbt command of {}: {}".format(
+                        entry["name"], entry["args"]
+                    )
+                )
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.critical("Invalid batch spec %s: %s", spec_path, e)
+        sys.exit(10)
+
+    # looked up once, the packaging processes inherit it
+    get_dependencies_artifact()
+
+    batch_name = generate_run_name("batch")
+    project_entries = {}
+    for index, entry in enumerate(entries):
+        entry["app_name"] = "{}.{}.{}".format(
+            batch_name, index, re.sub(r"[^A-Za-z0-9_-]", "_", entry["name"])
+        )
+        project_entries.setdefault(entry["project_dir"], []).append(entry)
+
+    parallelism = int(spec.get("parallelism", ENV_VARIABLES["YARN_BATCH_PARALLELISM"]))
+    with ProcessPoolExecutor(
+        max_workers=parallelism, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        submissions = {
+            submission["app_name"]: submission
+            for project_submissions in executor.map(
+                submit_dbt_batch_project, project_entries.values()
+            )
+            for submission in project_submissions
+        }
+
+    yarn_ids = [
+        submission["yarn_id"]
+        for submission in submissions.values()
+        if submission["yarn_id"]
+    ]
+    final_status = poll_yarn_apps(yarn_ids)
+
+    print("name application status exit_code submit_seconds queue_seconds run_seconds")
+    failed = False
+    for entry in entries:
+        submission = submissions[entry["app_name"]]
+        yarn_id = submission["yarn_id"]
+        queue_seconds = run_seconds = "-"
+        if yarn_id is None:
+            status, exit_code = "NOT_SUBMITTED", 10
+        else:
+            status = final_status[yarn_id]
+            exit_code = 0 if status == "SUCCEEDED" else 1
+            try:
+                app_report = get_yarn_app_report(yarn_id)
+                # ResourceManager times are epoch milliseconds
+                queue_seconds = round(
+                    (app_report["launchTime"] - app_report["startedTime"]) / 1000, 1
+                )
+                run_seconds = round(
+                    (app_report["finishedTime"] - app_report["launchTime"]) / 1000, 1
+                )
+            except (requests.RequestException, KeyError) as e:
+                logging.warning(
+                    "Couldn't fetch application report of %s: %s", yarn_id, e
+                )
+        failed = failed or exit_code != 0
+        print(
+            "{} {} {} {} {} {} {}".format(
+                entry["name"],
+                yarn_id or "-",
+                status,
+                exit_code,
+                submission["submit_seconds"],
+                queue_seconds,
+                run_seconds,
+            )
+        )
+
+    if failed:
+        logging.critical("There was an error completing dbt batch.")
+        sys.exit(10)
+
+
+# Package one project directory of a batch and submit its dbt commands, in a process of
+# the batch pool. Returns the application id and submission time of every command, the
+# application id is None when the submission failed.
+def submit_dbt_batch_project(entries):
+    global YARN_SESSION, PROJECT_ARCHIVE_DIR
+    # connections of the parent process can't be shared
+    YARN_SESSION = None
+
+    project_dir = entries[0]["project_dir"]
+    PROJECT_ARCHIVE_DIR = os.path.join(
+        YARN_DBT_STATE_DIR,
+        "batch",
+        hashlib.sha256(project_dir.encode()).hexdigest()[:16],
+    )
+    os.makedirs(PROJECT_ARCHIVE_DIR, exist_ok=True)
+    ENV_VARIABLES["DBT_PROJECT_NAME"] = os.path.basename(project_dir)
+    os.chdir(os.path.dirname(project_dir))
+
+    submissions = []
+    for entry in entries:
+        submit_start = time.time()
+        try:
+            yarn_id = submit_yarn_container_with_dbt_command(
+                entry["app_name"], entry["args"]
+            )
+        except SystemExit:
+            yarn_id = None
+        except Exception as e:
+            logging.critical("There was an error submitting %s: %s", entry["name"], e)
+            yarn_id = None
+        submissions.append(
+            {
+                "app_name": entry["app_name"],
+                "yarn_id": yarn_id,
+                "submit_seconds": round(time.time() - submit_start, 1),
+            }
+        )
+    return submissions
+
+
+# Upload dbt project to hdfs. The archive is staged under a name derived from its
+# content hash, so the upload is skipped when the same archive was staged before.
+# Returns the hdfs path of the staged archive.
+def copy_project_to_hdfs(compressed_project_directory):
+    return stage_file_in_hdfs(
+        compressed_project_directory,
+        "dbt-workspace-{}.{}".format(
+            hash_project_file(compressed_project_directory)[:16],
+            PROJECT_ARCHIVE_EXTENSIONS[ENV_VARIABLES["DBT_PROJECT_CODEC"]],
+        ),
+    )
+
+
+# Upload a file to the staging directory in hdfs unless it was staged before under the
+# same name. Staged names carry the content hash of the file, so a file with the same
+# name is the same file, and uploads are renamed into place once complete. With
+# WEBHDFS_URI set the upload goes through WebHDFS on the shared SPNEGO session,
+# otherwise the hdfs command line is used. Old staged files are cleaned up. Files that
+# long running services localize are staged to their own staging_dir, which isn't
+# cleaned up. Returns the hdfs path of the staged file.
+def stage_file_in_hdfs(local_path, staged_name, staging_dir=None):
+    cleanup = staging_dir is None
+    if staging_dir is None:
+        staging_dir = ENV_VARIABLES["DBT_PROJECT_STAGING_HDFS"]
+    staged_path = "{}/{}".format(staging_dir, staged_name)
+
+    # the staging directory is shared by all users
+    if cleanup:
+        ensure_shared_hdfs_dirs([staging_dir])
+
+    if not ENV_VARIABLES["WEBHDFS_URI"]:
+        exists = subprocess.run(
+            ["hdfs", "dfs", "-test", "-e", staged_path],
+            capture_output=True,
+            text=True,
+        )
+        if exists.returncode == 0:
+            logging.info("%s already staged at %s", local_path, staged_path)
+        else:
+            upload_file_to_hdfs(local_path, staged_path)
+            logging.info("Done uploading %s to %s", local_path, staged_path)
+        if cleanup:
+            cleanup_staged_files(staged_path)
+        return staged_path
+
+    try:
+        if get_webhdfs_file_status(staged_path):
+            logging.info("%s already staged at %s", local_path, staged_path)
+            # restart the retention period of the staged file
+            webhdfs_request(
+                "PUT",
+                staged_path,
+                "SETTIMES",
+                modificationtime=int(time.time() * 1000),
+            )
+        else:
+            upload_file_to_webhdfs(local_path, staged_path)
+            logging.info("Done uploading %s to %s", local_path, staged_path)
+        if cleanup:
+            cleanup_staged_files(staged_path)
+    except requests.RequestException as e:
+        logging.critical("There was an error uploading %s to hdfs.", local_path)
+        print(e)
+        sys.exit(10)
+    return staged_path
+
+
+# Upload a local file with the hdfs command line, which writes to a temporary
+# ._COPYING_ file that is renamed once complete, so a partial upload is never visible.
+def upload_file_to_hdfs(local_path, hdfs_path):
+    try:
+        subprocess.run(
+            ["hdfs", "dfs", "-mkdir", "-p", os.path.dirname(hdfs_path)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except subprocess.CalledProcessError as e:
+        logging.critical("There was an error uploading %s to hdfs.", local_path)
+        print(e.stderr)
+        sys.exit(10)
+    copied = subprocess.run(
+        ["hdfs", "dfs", "-copyFromLocal", local_path, hdfs_path],
+        capture_output=True,
+        text=True,
+    )
+    # unless another gateway staged the same file in the meantime
+    if (
+        copied.returncode != 0
+        and subprocess.run(
+            ["hdfs", "dfs", "-test", "-e", hdfs_path],
+            capture_output=True,
+            text=True,
+        ).returncode
+        != 0
+    ):
+        logging.critical("There was an error uploading %s to hdfs.", local_path)
+        print(copied.stderr)
+        sys.exit(10)
+
+
+# Send a request for a WebHDFS operation on an hdfs path.
+# Rest Api doc: https://hadoop.apache.org/docs/stable/hadoop-project-dist/hadoop-hdfs/WebHDFS.html
+def webhdfs_request(method, path, operation, **params):
+    params["op"] = operation
+    response = get_yarn_session().request(
+        method,
+        "{}/webhdfs/v1{}".format(ENV_VARIABLES["WEBHDFS_URI"], path),
+        params=params,
+        allow_redirects=False,
+        timeout=30,
+    )
+    response.raise_for_status()
+    return response
+
+
+# Return the WebHDFS file status of an hdfs path, or None when it doesn't exist.
+def get_webhdfs_file_status(path):
+    try:
+        return webhdfs_request("GET", path, "GETFILESTATUS").json()["FileStatus"]
+    except requests.HTTPError as e:
+        if e.response.status_code == 404:
+            return None
+        raise
+
+
+# Upload a local file through WebHDFS. Files larger than one chunk are written as
+# separate parts in parallel, which are concatenated afterwards. The upload goes to a
+# temporary path that is renamed once complete, so a partial upload is never visible.
+def upload_file_to_webhdfs(local_path, hdfs_path):
+    chunk_size = int(ENV_VARIABLES["DBT_PROJECT_UPLOAD_CHUNK_MB"]) * 1024 * 1024
+    size = os.path.getsize(local_path)
+    temporary_path = "{}.{}.tmp".format(hdfs_path, uuid.uuid4().hex[:8])
+    offsets = list(range(0, max(size, 1), chunk_size))
+    part_paths = [temporary_path] + [
+        "{}.part{}".format(temporary_path, index) for index in range(1, len(offsets))
+    ]
+
+    def upload_part(part_path, offset):
+        with open(local_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(chunk_size)
+        # the NameNode redirects the write to a DataNode
+        response = webhdfs_request("PUT", part_path, "CREATE", overwrite="true")
+        response = get_yarn_session().put(
+            response.headers["Location"],
+            data=data,
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=300,
+        )
+        response.raise_for_status()
+
+    logging.info("Uploading %s to %s in %s parts", local_path, hdfs_path, len(offsets))
+    with ThreadPoolExecutor(
+        max_workers=int(ENV_VARIABLES["DBT_PROJECT_UPLOAD_THREADS"])
+    ) as executor:
+        list(executor.map(upload_part, part_paths, offsets))
+
+    if len(part_paths) > 1:
+        webhdfs_request(
+            "POST", temporary_path, "CONCAT", sources=",".join(part_paths[1:])
+        )
+    renamed = webhdfs_request(
+        "PUT", temporary_path, "RENAME", destination=hdfs_path
+    ).json()["boolean"]
+    if not renamed:
+        # another gateway staged the same archive in the meantime
+        webhdfs_request("DELETE", temporary_path, "DELETE")
+
+
+# Delete the staged files that weren't used for the retention period, at most once an
+# hour from a gateway. The staging directory is used by yarn_dbt only, see
+# ensure_shared_hdfs_dirs. The hdfs command line can't refresh the modification time of
+# a file that is staged again, such a file is uploaded again once it expired.
+def cleanup_staged_files(staged_path):
+    marker_path = os.path.join(YARN_DBT_STATE_DIR, "staging_cleanup")
+    try:
+        if time.time() - os.path.getmtime(marker_path) < 3600:
+            return
+    except OSError:
+        pass
+    try:
+        os.makedirs(YARN_DBT_STATE_DIR, exist_ok=True)
+        with open(marker_path, "w"):
+            pass
+    except OSError as e:
+        logging.warning("Couldn't write %s: %s", marker_path, e)
+
+    staging_dir = ENV_VARIABLES["DBT_PROJECT_STAGING_HDFS"]
+    expiry = (
+        time.time()
+        - float(ENV_VARIABLES["DBT_PROJECT_STAGING_RETENTION_DAYS"]) * 24 * 3600
+    ) * 1000
+
+    if ENV_VARIABLES["WEBHDFS_URI"]:
+        file_statuses = webhdfs_request("GET", staging_dir, "LISTSTATUS").json()
+        staged_files = [
+            (
+                "{}/{}".format(staging_dir, file_status["pathSuffix"]),
+                file_status["modificationTime"],
+            )
+            for file_status in file_statuses["FileStatuses"]["FileStatus"]
+        ]
+    else:
+        stat = subprocess.run(
+            ["hdfs", "dfs", "-stat", "%Y %n", staging_dir + "/*"],
+            capture_output=True,
+            text=True,
+        )
+        staged_files = [
+            ("{}/{}".format(staging_dir, name), int(modification_time))
+            for modification_time, name in (
+                line.split(" ", 1) for line in stat.stdout.splitlines() if " " in line
+            )
+        ]
+
+    expired = [
+        path
+        for path, modification_time in staged_files
+        if path != staged_path and modification_time < expiry
+    ]
+    if not expired:
+        return
+    if ENV_VARIABLES["WEBHDFS_URI"]:
+        for path in expired:
+            try:
+                webhdfs_request("DELETE", path, "DELETE")
+                logging.info("Deleted staged file %s", path)
+            except requests.HTTPError as e:
+                # files staged by other users can't be deleted from a sticky directory
+                logging.debug("Couldn't delete staged file %s: %s", path, e)
+    else:
+        removed = subprocess.run(
+            ["hdfs", "dfs", "-rm", "-f", "-skipTrash"] + expired,
+            capture_output=True,
+            text=True,
+        )
+        logging.info("Deleted expired staged files from %s", staging_dir)
+        # files staged by other users can't be deleted from a sticky directory
+        logging.debug("%s", removed.stderr)
+
+
+# Create hdfs directories that all users of yarn_dbt write to. Like /tmp they are world
+# writable with the sticky bit set, so that the user who happens to create them first
+# doesn't lock out the others and users can only delete their own files. Directories
+# owned by another user can't be changed and are used as they are. The directories
+# prepared from this gateway are remembered in the yarn_dbt state directory.
+def ensure_shared_hdfs_dirs(paths):
+    prepared_path = os.path.join(YARN_DBT_STATE_DIR, "shared_hdfs_dirs.json")
+    try:
+        with open(prepared_path) as f:
+            prepared = json.load(f)
+    except (OSError, ValueError):
+        prepared = []
+    paths = [path for path in paths if path not in prepared]
+    if not paths:
+        return
+
+    try:
+        if ENV_VARIABLES["WEBHDFS_URI"]:
+            for path in paths:
+                webhdfs_request("PUT", path, "MKDIRS")
+                try:
+                    webhdfs_request("PUT", path, "SETPERMISSION", permission="1777")
+                except requests.HTTPError as e:
+                    logging.warning("Couldn't share hdfs directory %s: %s", path, e)
+        else:
+            subprocess.run(
+                ["hdfs", "dfs", "-mkdir", "-p"] + paths,
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            chmod = subprocess.run(
+                ["hdfs", "dfs", "-chmod", "1777"] + paths,
+                capture_output=True,
+                text=True,
+            )
+            if chmod.returncode != 0:
+                logging.warning(
+                    "Couldn't share hdfs directories: %s", chmod.stderr.strip()
+                )
+    except requests.RequestException as e:
+        logging.critical("There was an error creating hdfs directories %s.", paths)
+        print(e)
+        sys.exit(10)
+    except subprocess.CalledProcessError as e:
+        logging.critical("There was an error creating hdfs directories %s.", paths)
+        print(e.stderr)
+        sys.exit(10)
+
+    try:
+        os.makedirs(YARN_DBT_STATE_DIR, exist_ok=True)
+        with open(prepared_path, "w") as f:
+            json.dump(prepared + paths, f)
+    except OSError as e:
+        logging.warning("Couldn't write %s: %s", prepared_path, e)
+
+
+# Build the dbt runtime once from the wheel bundle and publish it to HDFS as a packed,
+# relocatable environment that yarn containers unpack instead of running pip install.
+# The environment links to the python3 interpreter of the gateway, the same interpreter
+# path must be available on the yarn nodes.
+def build_python_environment():
+    if venv_pack is None:
+        logging.critical(
+            "Building the python environment requires venv-pack: pip install venv-pack"
+        )
+        sys.exit(10)
+
+    build_dir = tempfile.mkdtemp(prefix="dbt-env-")
+    venv_dir = os.path.join(build_dir, "dbt-venv")
+    packed_environment = os.path.join(build_dir, ENV_VARIABLES["DEPENDENCIES_ENV_NAME"])
+    logging.info("Building dbt python environment in %s", build_dir)
+
+    try:
+        subprocess.run(
+            [
+                "hdfs",
+                "dfs",
+                "-copyToLocal",
+                "{}/{}".format(
+                    ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"],
+                    ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"],
+                ),
+                build_dir,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        subprocess.run(
+            [
+                "tar",
+                "-zxf",
+                os.path.join(build_dir, ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"]),
+                "--directory",
+                build_dir,
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        subprocess.run(
+            ["python3", "-m", "venv", venv_dir],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+
+        dependencies_dir = os.path.join(build_dir, "dependencies")
+        subprocess.run(
+            [
+                os.path.join(venv_dir, "bin", "pip"),
+                "install",
+                "-q",
+                "-f",
+                "./",
+                "--no-index",
+            ]
+            + sorted(os.listdir(dependencies_dir)),
+            cwd=dependencies_dir,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+
+        venv_pack.pack(prefix=venv_dir, output=packed_environment)
+        logging.info("Done packing dbt python environment: %s", packed_environment)
+
+        subprocess.run(
+            [
+                "hdfs",
+                "dfs",
+                "-copyFromLocal",
+                "-f",
+                packed_environment,
+                ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"],
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except subprocess.CalledProcessError as e:
+        logging.critical("There was an error building the dbt python environment.")
+        print(e.stderr)
+        sys.exit(10)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    print(
+        "Published dbt python environment to {}/{}".format(
             ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"],
-            ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"],
-            yarn_local_working_dir,
-            yarn_local_working_dir,
-            ENV_VARIABLES["DEPENDENCIES_PACKAGE_NAME"],
-            yarn_local_working_dir,
+            ENV_VARIABLES["DEPENDENCIES_ENV_NAME"],
         )
     )
 
-    populate_working_dir_command = "source {}/dbt-venv/bin/activate && cd {}/dependencies && {}/dbt-venv/bin/pip install * -f ./ --no-index".format(
-        yarn_local_working_dir,
-        yarn_local_working_dir,
-        yarn_local_working_dir,
+
+# Generate the dbt docs once in a batch yarn container that publishes them to HDFS. The
+# static file server is staged next to the docs while yarn_dbt still runs as the user
+# that owns the docs directory. Returns the hdfs directory of the docs.
+def generate_dbt_docs():
+    app_name = generate_run_name("docs")
+    yarn_id = submit_yarn_container_with_dbt_command(
+        app_name, ["docs", "generate"], DBT_DOCS_ARTIFACTS
     )
+    if poll_yarn_apps([yarn_id])[yarn_id] != "SUCCEEDED":
+        print_yarn_logs(yarn_id, "prelaunch.out")
+        logging.critical("There was an error generating dbt docs.")
+        sys.exit(10)
+    docs_path = "{}/{}".format(ENV_VARIABLES["DBT_ARTIFACTS_PATH_HDFS"], app_name)
+    stage_file_in_hdfs(DBT_DOCS_SERVER, "dbt_docs_server.py", docs_path)
+    return docs_path
+
 
-    download_dbt_project_from_hdfs = "hdfs dfs -copyToLocal /tmp/dbt-workspace.tar.gz {} && tar -zxf {}/dbt-workspace.tar.gz --directory {}".format(
-        yarn_local_working_dir,
-        yarn_local_working_dir,
-        yarn_local_working_dir,
+# generate JSON payload dynamically to send to yarn container to serve the prebuilt dbt
+# docs. The docs and the static file server are localized by the NodeManager, the
+# container doesn't need a python environment or the dbt project.
+def generate_yarn_payload(docs_path):
+    kerberos_principal = {}
+    service_user_keytab = get_service_user_keytab()
+    kerberos_principal["keytab"] = "file://{}".format(service_user_keytab)
+    host = socket.gethostname()
+    kerberos_principal["principal_name"] = "{}/{}".format(
+        ENV_VARIABLES["DBT_SERVICE_USER"], host
     )
+    # staged next to the docs by generate_dbt_docs
+    staged_docs_server = "{}/dbt_docs_server.py".format(docs_path)
 
-    generate_serve_dbt_docs = "cd {}/{} && {}/dbt-venv/bin/dbt docs generate --profiles-dir={}/{} ; echo 'DBT docs hosted on port {} on host: ' $(hostname) >&2 && python3 -m http.server {} --directory target".format(
-        yarn_local_working_dir,
-        ENV_VARIABLES["DBT_PROJECT_NAME"],
-        yarn_local_working_dir,
-        yarn_local_working_dir,
-        ENV_VARIABLES["DBT_PROJECT_NAME"],
-        ENV_VARIABLES["DBT_DOCS_PORT"],
-        ENV_VARIABLES["DBT_DOCS_PORT"],
+    component = {}
+    component["name"] = "dbtdocs"
+    component["number_of_containers"] = int(ENV_VARIABLES["DBT_DOCS_CONTAINERS"])
+
+    localized_files = [
+        {
+            "type": "STATIC",
+            "src_file": "{}/{}".format(docs_path, artifact),
+            "dest_file": artifact,
+        }
+        for artifact in DBT_DOCS_ARTIFACTS
+    ]
+    localized_files.append(
+        {
+            "type": "STATIC",
+            "src_file": staged_docs_server,
+            "dest_file": "dbt_docs_server.py",
+        }
     )
 
-    # commands are meant to sequentially after previous success except dbt_logs_command that runs regardless of dbt_command success/failure.
-    launch_command = "{} && {} && {} && {} && {}".format(
-        create_working_dir_command,
-        download_python_dependencies_from_hdfs,
-        populate_working_dir_command,
-        download_dbt_project_from_hdfs,
-        generate_serve_dbt_docs,
+    # the localized files are read only links, the server writes compressed copies
+    launch_command = "mkdir -p docs && cp {} docs && echo 'DBT docs hosted on port {} on host: ' $(hostname) >&2 && python3 dbt_docs_server.py --port {} --directory docs".format(
+        " ".join(DBT_DOCS_ARTIFACTS),
+        ENV_VARIABLES["DBT_DOCS_PORT"],
+        ENV_VARIABLES["DBT_DOCS_PORT"],
     )
 
     logging.info(launch_command)
@@ -527,30 +2923,436 @@ def generate_yarn_payload():
     env = {}
     configuration = {}
     configuration["env"] = env
+    configuration["files"] = localized_files
     component["configuration"] = configuration
 
     payload = {}
     payload["name"] = "dbt-service"
-    payload["version"] = "1.0"
+    # every docs build is a new version the running service can be upgraded to
+    payload["version"] = os.path.basename(docs_path)
     payload["kerberos_principal"] = kerberos_principal
+    payload["configuration"] = {"properties": {"yarn.service.upgrade.enabled": "true"}}
     payload["components"] = [component]
     logging.info("Payload generation done: \n%s", json.dumps(payload, indent=2))
     return payload
 
 
-# host dbt docs on yarn container
-def host_dbt_docs():
-    payload = generate_yarn_payload()
-    headers = {"Content-Type": "application/json"}
-    gssapi_auth = HTTPSPNEGOAuth()
+# host dbt docs on yarn container. A running docs service is upgraded in place: its
+# containers are reinitialized with the new docs without giving up their allocation.
+# The service is only created from scratch when it doesn't exist, isn't running, or was
+# launched without upgrades enabled.
+def host_dbt_docs(docs_path):
+    payload = generate_yarn_payload(docs_path)
+    service_name = payload["name"]
+    component = payload["components"][0]
+    session = get_yarn_session()
 
-    # Rest Api doc: https://hadoop.apache.org/docs/stable/hadoop-yarn/hadoop-yarn-site/yarn-service/YarnServiceAPI.html#ConfigFile
-    response = requests.post(
-        ENV_VARIABLES["YARN_RM_URI"] + "/app/v1/services",
-        data=json.dumps(payload),
-        auth=gssapi_auth,
-        headers=headers,
-        verify=False,
+    # Rest Api doc: https://hadoop.apache.org/docs/stable/hadoop-yarn/hadoop-yarn-site/yarn-service/YarnServiceAPI.html
+    services_uri = ENV_VARIABLES["YARN_RM_URI"] + "/app/v1/services"
+    service_uri = "{}/{}".format(services_uri, service_name)
+    try:
+        service = get_yarn_service(service_name)
+        state = service["state"] if service else None
+        upgradable = (service or {}).get("configuration", {}).get("properties", {}).get(
+            "yarn.service.upgrade.enabled"
+        ) == "true"
+
+        if state in ["ACCEPTED", "FLEX", "UPGRADING", "EXPRESS_UPGRADING"]:
+            logging.critical(
+                "Service %s is %s, try again once it is stable.", service_name, state
+            )
+            sys.exit(10)
+        elif state in ["STARTED", "STABLE"] and upgradable:
+            running_containers = next(
+                (
+                    running_component.get("number_of_containers")
+                    for running_component in service.get("components", [])
+                    if running_component["name"] == component["name"]
+                ),
+                None,
+            )
+            if running_containers != component["number_of_containers"]:
+                flex_yarn_component(
+                    service_name, component["name"], component["number_of_containers"]
+                )
+                # the service can't be upgraded while it is flexing
+                deadline = time.time() + int(ENV_VARIABLES["YARN_TIMEOUT"]) / 1000
+                while True:
+                    service = get_yarn_service(service_name)
+                    if service is None:
+                        logging.critical(
+                            "Service %s went away while flexing.", service_name
+                        )
+                        sys.exit(10)
+                    if service["state"] in ["STARTED", "STABLE"]:
+                        break
+                    if time.time() > deadline:
+                        logging.critical(
+                            "Service %s didn't become stable after flexing, it is %s.",
+                            service_name,
+                            service["state"],
+                        )
+                        sys.exit(10)
+                    time.sleep(int(ENV_VARIABLES["YARN_POLL_INTERVAL"]))
+
+            logging.info("Upgrading service %s to %s", service_name, payload["version"])
+            payload["state"] = "EXPRESS_UPGRADING"
+            response = session.put(service_uri, json=payload, timeout=30)
+            response.raise_for_status()
+        else:
+            if service:
+                destroy_yarn_service(service_name)
+            logging.info("Creating service %s", service_name)
+            response = session.post(services_uri, json=payload, timeout=30)
+            response.raise_for_status()
+    except requests.RequestException as e:
+        logging.critical("There was an error hosting dbt docs.")
+        print(e)
+        sys.exit(10)
+    print(response.text)
+
+
+# Fetch the spec and state of a yarn service, or None when it doesn't exist.
+def get_yarn_service(service_name):
+    response = get_yarn_session().get(
+        "{}/app/v1/services/{}".format(ENV_VARIABLES["YARN_RM_URI"], service_name),
+        timeout=30,
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
+# Change the number of containers of a component of a yarn service.
+def flex_yarn_component(service_name, component_name, number_of_containers):
+    logging.info("Flexing %s to %s containers", component_name, number_of_containers)
+    response = get_yarn_session().put(
+        "{}/app/v1/services/{}/components/{}".format(
+            ENV_VARIABLES["YARN_RM_URI"], service_name, component_name
+        ),
+        json={"number_of_containers": number_of_containers},
+        timeout=30,
+    )
+    response.raise_for_status()
+
+
+# Stop and destroy a yarn service and wait until it is gone, so that a new service with
+# the same name can be created.
+def destroy_yarn_service(service_name):
+    logging.info("Destroying service %s", service_name)
+    response = get_yarn_session().delete(
+        "{}/app/v1/services/{}".format(ENV_VARIABLES["YARN_RM_URI"], service_name),
+        timeout=30,
+    )
+    if response.status_code != 404:
+        response.raise_for_status()
+    while get_yarn_service(service_name) is not None:
+        time.sleep(int(ENV_VARIABLES["YARN_POLL_INTERVAL"]))
+
+
+# Name of the warm dbt worker service of the current user. Service names only allow
+# lowercase letters, digits and dashes.
+def get_worker_service_name():
+    return "dbt-worker-{}".format(
+        re.sub(r"[^a-z0-9-]", "-", ENV_VARIABLES["CURRENT_DBT_USER"].lower())
+    )
+
+
+# Path of the gateway copy of the token that authenticates yarn_dbt to the dbt workers.
+def get_worker_token_path():
+    return os.path.join(YARN_DBT_STATE_DIR, "worker_token")
+
+
+# Create a new worker token, readable only by the current user on the gateway and in
+# its hdfs home directory, where the worker containers localize it from. Returns the
+# hdfs path of the token.
+def create_worker_token():
+    os.makedirs(YARN_DBT_STATE_DIR, exist_ok=True)
+    token_path = get_worker_token_path()
+    with open(
+        os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w"
+    ) as f:
+        f.write(secrets.token_hex(32))
+
+    hdfs_token_dir = "/user/{}/.yarn_dbt".format(ENV_VARIABLES["CURRENT_DBT_USER"])
+    hdfs_token_path = "{}/worker_token".format(hdfs_token_dir)
+    for command in [
+        ["-mkdir", "-p", hdfs_token_dir],
+        ["-put", "-f", token_path, hdfs_token_path],
+    ]:
+        # the token is never visible to other users, not even between upload and chmod
+        subprocess.run(
+            ["hdfs", "dfs", "-D", "fs.permissions.umask-mode=077"] + command,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    return hdfs_token_path
+
+
+# generate JSON payload of the warm dbt worker service. Every worker container prepares
+# the python environment once and then serves dbt commands until it is recycled.
+def generate_worker_payload(hdfs_token_path):
+    # the worker containers localize the script for as long as the service runs
+    staged_worker = stage_file_in_hdfs(
+        DBT_WORKER,
+        "dbt_worker-{}.py".format(hash_project_file(DBT_WORKER)[:16]),
+        os.path.dirname(hdfs_token_path),
     )
+    working_dir = "$container_dir/work"
+
+    localized_files = [
+        {"type": "STATIC", "src_file": staged_worker, "dest_file": "dbt_worker.py"},
+        {"type": "STATIC", "src_file": hdfs_token_path, "dest_file": "worker_token"},
+    ]
+    artifact, cache_key = get_dependencies_artifact()
+    localized_dependencies = None
+    if is_native_archive(artifact):
+        localized_files.append(
+            {
+                "type": "ARCHIVE",
+                "src_file": "{}/{}".format(
+                    ENV_VARIABLES["DEPENDENCIES_PACKAGE_PATH_HDFS"], artifact
+                ),
+                "dest_file": "dbt-dependencies",
+            }
+        )
+        localized_dependencies = "$container_dir/dbt-dependencies"
+
+    python_environment_phases, venv_dir = generate_python_environment_phases(
+        working_dir, localized_dependencies
+    )
+
+    launch_command = "set -o pipefail ; container_dir=$PWD && mkdir -p {0} && kinit -kt {1} {2} && {3} && source {4}/bin/activate && exec python3 $container_dir/dbt_worker.py --port {5} --token-file $container_dir/worker_token --workdir {0} --staging-dir {7} --keytab {1} --principal {2} --max-runs {6}".format(
+        working_dir,
+        ENV_VARIABLES["DBT_HEADLESS_KEYTAB"],
+        ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"],
+        " && ".join(command for phase, command in python_environment_phases),
+        venv_dir,
+        ENV_VARIABLES["DBT_WORKER_PORT"],
+        ENV_VARIABLES["DBT_WORKER_MAX_RUNS"],
+        ENV_VARIABLES["DBT_PROJECT_STAGING_HDFS"],
+    )
+    logging.info(launch_command)
+
+    component = {}
+    component["name"] = "dbtworker"
+    component["number_of_containers"] = int(ENV_VARIABLES["DBT_WORKER_MIN"])
+    component["launch_command"] = launch_command
+    component["resource"] = {
+        "cpus": 1,
+        "memory": ENV_VARIABLES["YARN_CONTAINER_MEMORY"],
+    }
+    # recycled workers exit and are relaunched by yarn
+    component["restart_policy"] = "ALWAYS"
+    # every worker listens on the same port, at most one worker per node
+    component["placement_policy"] = {
+        "constraints": [
+            {
+                "type": "ANTI_AFFINITY",
+                "scope": "NODE",
+                "target_tags": [component["name"]],
+            }
+        ]
+    }
+    component["configuration"] = {
+        "env": {
+            "DBT_DEPLOYMENT_ENV": json.dumps({"env": "yarn", "version": "1.2.0"}),
+        },
+        "files": localized_files,
+    }
+
+    payload = {}
+    payload["name"] = get_worker_service_name()
+    payload["version"] = datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S")
+    payload["kerberos_principal"] = {
+        "principal_name": ENV_VARIABLES["DBT_HEADLESS_PRINCIPAL"],
+        "keytab": "file://{}".format(ENV_VARIABLES["DBT_HEADLESS_KEYTAB"]),
+    }
+    payload["components"] = [component]
+    logging.info("Payload generation done: \n%s", json.dumps(payload, indent=2))
+    return payload
+
+
+# Start the warm dbt worker service of the current user unless it is running already.
+def start_dbt_workers():
+    service_name = get_worker_service_name()
+    try:
+        service = get_yarn_service(service_name)
+        if service and service["state"] in ["ACCEPTED", "STARTED", "STABLE", "FLEX"]:
+            print("dbt workers are running: {}".format(service_name))
+            return
+        if service:
+            destroy_yarn_service(service_name)
+
+        payload = generate_worker_payload(create_worker_token())
+        response = get_yarn_session().post(
+            ENV_VARIABLES["YARN_RM_URI"] + "/app/v1/services", json=payload, timeout=30
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logging.critical("There was an error starting the dbt workers.")
+        print(e)
+        sys.exit(10)
     print(response.text)
 
+
+# Query the status of every ready dbt worker of the service, keyed by worker endpoint.
+# The workers are not behind SPNEGO, they authenticate requests with the worker token.
+def get_dbt_worker_statuses(service):
+    if not os.path.isfile(get_worker_token_path()):
+        logging.info("No dbt worker token in %s.", get_worker_token_path())
+        return {}
+    with open(get_worker_token_path()) as f:
+        headers = {"Authorization": "Bearer {}".format(f.read().strip())}
+
+    statuses = {}
+    for component in service.get("components", []):
+        for container in component.get("containers", []):
+            if container.get("state") != "READY":
+                continue
+            endpoint = "http://{}:{}".format(
+                container.get("bare_host") or container["ip"],
+                ENV_VARIABLES["DBT_WORKER_PORT"],
+            )
+            try:
+                response = requests.get(
+                    endpoint + "/status", headers=headers, timeout=10
+                )
+                response.raise_for_status()
+                statuses[endpoint] = response.json()
+            except requests.RequestException as e:
+                logging.debug("dbt worker %s isn't available: %s", endpoint, e)
+    return statuses
+
+
+# Print a one line json status for each dbt worker.
+def print_dbt_worker_status():
+    service = get_yarn_service(get_worker_service_name())
+    if service is None:
+        print("No dbt workers running.")
+        return
+    print(json.dumps({"service": service["name"], "state": service["state"]}))
+    for endpoint, status in get_dbt_worker_statuses(service).items():
+        status["endpoint"] = endpoint
+        print(json.dumps(status))
+
+
+# Run a dbt command on a warm dbt worker and print its output. Idle workers that have
+# the same project loaded are preferred. When all workers are busy the pool grows up to
+# DBT_WORKER_MAX containers, workers that stay idle longer than DBT_WORKER_IDLE_TIMEOUT
+# are released again. Returns False when no worker service is running.
+def run_dbt_on_worker(dbt_args):
+    service_name = get_worker_service_name()
+    try:
+        service = get_yarn_service(service_name)
+        if service is None or service["state"] not in ["STARTED", "STABLE", "FLEX"]:
+            logging.info("No dbt workers running, launching a yarn container.")
+            return False
+        # the token is only readable by the user that started the dbt workers
+        if not os.path.isfile(get_worker_token_path()):
+            logging.info(
+                "No dbt worker token in %s, launching a yarn container.",
+                get_worker_token_path(),
+            )
+            return False
+
+        run_name = generate_run_name("worker")
+        staged_project = copy_project_to_hdfs(package_project_for_run(run_name))
+        release_run_files(run_name)
+        deadline = time.time() + int(ENV_VARIABLES["YARN_TIMEOUT"]) / 1000
+        while True:
+            statuses = get_dbt_worker_statuses(service)
+            for endpoint, status in sorted(
+                statuses.items(),
+                key=lambda item: (
+                    item[1]["busy"],
+                    item[1]["project"] != staged_project,
+                ),
+            ):
+                if status["busy"]:
+                    continue
+                exit_code = dispatch_to_dbt_worker(endpoint, staged_project, dbt_args)
+                if exit_code is None:
+                    continue
+                scale_down_dbt_workers(service_name)
+                if exit_code != 0:
+                    logging.critical("There was an error completing dbt command.")
+                    sys.exit(10)
+                return True
+
+            # all workers are busy
+            component = service["components"][0]
+            if component["number_of_containers"] < int(ENV_VARIABLES["DBT_WORKER_MAX"]):
+                flex_yarn_component(
+                    service_name,
+                    component["name"],
+                    component["number_of_containers"] + 1,
+                )
+            if time.time() > deadline:
+                logging.critical("No dbt worker became available.")
+                sys.exit(10)
+            time.sleep(int(ENV_VARIABLES["YARN_POLL_INTERVAL"]))
+            service = get_yarn_service(service_name)
+    except requests.RequestException as e:
+        logging.critical("There was an error running dbt command on a dbt worker.")
+        print(e)
+        sys.exit(10)
+
+
+# Send a dbt command to a dbt worker and print the output while it runs. Returns the
+# exit code of dbt, or None when the worker got busy in the meantime.
+def dispatch_to_dbt_worker(endpoint, staged_project, dbt_args):
+    with open(get_worker_token_path()) as f:
+        headers = {"Authorization": "Bearer {}".format(f.read().strip())}
+
+    logging.info("Running dbt command on dbt worker %s", endpoint)
+    response = requests.post(
+        endpoint + "/run",
+        json={
+            "project": staged_project,
+            "project_name": ENV_VARIABLES["DBT_PROJECT_NAME"],
+            "args": dbt_args,
+        },
+        headers=headers,
+        stream=True,
+        timeout=(10, None),
+    )
+    if response.status_code == 409:
+        return None
+    response.raise_for_status()
+
+    exit_code = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith(DBT_WORKER_EXIT_CODE_MARKER):
+            exit_code = int(line[len(DBT_WORKER_EXIT_CODE_MARKER) :])
+        else:
+            print(line)
+            sys.stdout.flush()
+    if exit_code is None:
+        raise requests.ConnectionError("dbt worker {} went away".format(endpoint))
+    return exit_code
+
+
+# Release the dbt workers that were idle for longer than DBT_WORKER_IDLE_TIMEOUT. yarn
+# picks the containers that are released, so the pool only shrinks while no worker is
+# busy.
+def scale_down_dbt_workers(service_name):
+    service = get_yarn_service(service_name)
+    component = service["components"][0]
+    statuses = get_dbt_worker_statuses(service)
+    if any(status["busy"] for status in statuses.values()):
+        return
+
+    expired = [
+        endpoint
+        for endpoint, status in statuses.items()
+        if status["idle_seconds"] >= int(ENV_VARIABLES["DBT_WORKER_IDLE_TIMEOUT"])
+    ]
+    number_of_containers = max(
+        int(ENV_VARIABLES["DBT_WORKER_MIN"]),
+        component["number_of_containers"] - len(expired),
+    )
+    if number_of_containers < component["number_of_containers"]:
+        flex_yarn_component(service_name, component["name"], number_of_containers)